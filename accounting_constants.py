@@ -0,0 +1,8 @@
+# Copyright 2019 Eric Norman
+# Accounting constants of a quote, for quoting_engine (one quote at a time) and
+# batch_accounting (whole columns). Nothing else is imported here, so offline
+# accounting does not load or configure the provider clients.
+
+
+PLATFORM_FEE_PERCENT =?? #[REDACTED]
+SHIPPING_ACCOUNT_HOLDER_RATE = ?? #[REDACTED]
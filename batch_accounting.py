@@ -0,0 +1,152 @@
+# Copyright 2019 Eric Norman
+# calculate_accounting_info_from_customer_facing_quote over whole columns at once
+# (numpy), for re-running accounting over historical quotes.
+# Same fields, same skip rule and the same numbers as the one-quote function,
+# rounding included: Python's round() is correctly rounded, numpy's is not
+# (it scales first), so the few values numpy could get wrong are redone with round().
+#
+#     present, internal, skipped = batch_accounting(best_rate, comparison_rate, ...)
+#     write_csv('accounting.csv', present, internal, skipped, customer_order_id)
+
+
+import csv
+import numpy as np
+
+from accounting_constants import PLATFORM_FEE_PERCENT, SHIPPING_ACCOUNT_HOLDER_RATE
+
+
+# Same placeholder as the one-quote function
+ORDER_TIMESTAMP = '2019-05-28'  #TODO: dynamic, or order ID
+PRESENT_TO_CUSTOMER_FIELDS = ['our_service', 'our_quote', 'comparison_quote', 'comparison_service',
+                              'savings', 'savings_percent']
+INTERNAL_ACCOUNTING_FIELDS = ['order timestamp', 'platform fee', 'cost shipping', 'cost insurance',
+                              'cost account holder', 'shipping account holder fee',
+                              'shipping account holder payable', 'customer receivable', 'cost of goods',
+                              'gross', 'gross margin']
+# x * 10**digits this close to a half could round the other way in numpy than in round()
+_HALF_TOLERANCE = 1e-6
+
+
+def round_like_python(x, digits):
+    """round(x, digits) for every element, exactly.
+
+    Args:
+        x(np.ndarray of float)
+
+    Returns:
+        rounded(np.ndarray of float)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    rounded = np.round(x, digits)
+    scaled = x * 10.0 ** digits
+    near_half = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < _HALF_TOLERANCE
+    near_half &= np.isfinite(x)
+    for i in np.flatnonzero(near_half):
+        rounded.flat[i] = round(float(x.flat[i]), digits)
+    return rounded
+
+
+def _service_names(carrier, service):
+    """'FedEx Ground' stays, 'Priority' becomes 'USPS Priority'; same rule as the one-quote code"""
+    return np.array([
+        s if c.casefold() in s.casefold() else c + ' ' + s
+        for c, s in zip(carrier, service)], dtype=object)
+
+
+def batch_accounting(best_rate, comparison_rate, best_carrier, best_service, comparison_service):
+    """calculate_accounting_info_from_customer_facing_quote for n quotes.
+
+    Args:
+        best_rate(np.ndarray of float): best_quote['rate']
+        comparison_rate(np.ndarray of float): comparison_quote['rate']
+        best_carrier, best_service(sequence of str): best_quote['carrier'] / ['service']
+        comparison_service(sequence of str): comparison_quote['service']
+
+    Returns:
+        tuple[0] present_to_customer(dict): field -> np.ndarray, without the
+            from / to / parcel headers (those are the inputs as they are)
+        tuple[1] internal_accounting_info(dict): field -> np.ndarray
+        tuple[2] skipped(np.ndarray of bool): where the one-quote function skips
+            (returns ({},{})); the columns are NaN / None there
+    """
+    best_rate = np.asarray(best_rate, dtype=np.float64)
+    comparison_rate = np.asarray(comparison_rate, dtype=np.float64)
+    n = len(best_rate)
+
+    our_rate = best_rate / (1 - PLATFORM_FEE_PERCENT)
+    # Stop if comparison is worse
+    skipped = comparison_rate < our_rate
+
+    present_to_customer = {}
+    our_service = _service_names(best_carrier, best_service)
+    our_service[skipped] = None
+    present_to_customer['our_service'] = our_service
+    present_to_customer['our_quote'] = round_like_python(our_rate, 2)
+    present_to_customer['comparison_quote'] = round_like_python(comparison_rate, 2)
+    comparison_service = np.array(comparison_service, dtype=object)
+    comparison_service[skipped] = None
+    present_to_customer['comparison_service'] = comparison_service
+    present_to_customer['savings'] = round_like_python(
+        present_to_customer['comparison_quote'] - present_to_customer['our_quote'], 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        present_to_customer['savings_percent'] = round_like_python(
+            100 * present_to_customer['savings'] / present_to_customer['comparison_quote'], 0)
+
+    internal_accounting_info = {}
+    internal_accounting_info['order timestamp'] = np.full(n, ORDER_TIMESTAMP, dtype=object)
+    internal_accounting_info['platform fee'] = np.full(n, PLATFORM_FEE_PERCENT, dtype=np.float64)
+    internal_accounting_info['cost shipping'] = round_like_python(best_rate, 2)
+    internal_accounting_info['cost insurance'] = np.zeros(n)  #TODO: update with insurance update
+    internal_accounting_info['cost account holder'] = round_like_python(best_rate, 2)
+    internal_accounting_info['shipping account holder fee'] = round_like_python(
+        best_rate * SHIPPING_ACCOUNT_HOLDER_RATE, 2)
+    internal_accounting_info['shipping account holder payable'] = round_like_python(
+        internal_accounting_info['shipping account holder fee'] + internal_accounting_info['cost shipping'], 2)
+    internal_accounting_info['customer receivable'] = round_like_python(our_rate, 2)
+    internal_accounting_info['cost of goods'] = round_like_python(
+        internal_accounting_info['cost shipping'] + internal_accounting_info['cost insurance'], 2)
+    internal_accounting_info['gross'] = (
+        internal_accounting_info['customer receivable'] - internal_accounting_info['cost of goods'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        internal_accounting_info['gross margin'] = round_like_python(
+            internal_accounting_info['gross'] / internal_accounting_info['customer receivable'], 2)
+
+    for columns in (present_to_customer, internal_accounting_info):
+        for field, column in columns.items():
+            if column.dtype == np.float64:
+                column[skipped] = np.nan
+            else:
+                column[skipped] = None
+    return present_to_customer, internal_accounting_info, skipped
+
+
+def columns_from_quotes(quotes):
+    """(best_quote, comparison_quote) pairs, as returned by
+    pull_and_calculate_customer_facing_quote, -> batch_accounting arguments.
+
+    Returns:
+        columns(dict): best_rate, comparison_rate, best_carrier, best_service, comparison_service
+    """
+    quotes = list(quotes)
+    return {
+        'best_rate': np.fromiter((b['rate'] for b, c in quotes), np.float64, len(quotes)),
+        'comparison_rate': np.fromiter((c['rate'] for b, c in quotes), np.float64, len(quotes)),
+        'best_carrier': [b['carrier'] for b, c in quotes],
+        'best_service': [b['service'] for b, c in quotes],
+        'comparison_service': [c['service'] for b, c in quotes],
+    }
+
+
+def write_csv(path, present_to_customer, internal_accounting_info, skipped, customer_order_id=None):
+    """One row per quote, skipped ones included (status column)"""
+    fields = PRESENT_TO_CUSTOMER_FIELDS + INTERNAL_ACCOUNTING_FIELDS
+    columns = [present_to_customer[f] for f in PRESENT_TO_CUSTOMER_FIELDS] + [
+        internal_accounting_info[f] for f in INTERNAL_ACCOUNTING_FIELDS]
+    status = np.where(skipped, 'skipped', 'quoted')
+    if customer_order_id is None:
+        customer_order_id = np.arange(len(skipped))
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['customer_order_id', 'status'] + fields)
+        writer.writerows(zip(customer_order_id, status, *[
+            np.where(skipped, '', column.astype(object)) for column in columns]))
@@ -0,0 +1,172 @@
+# Copyright 2019 Eric Norman
+# Quoting benchmarks against the local provider stand-ins in fake_providers.py;
+# no keys, no network. Reports quotes/sec, p50/p95/p99 latency and allocations.
+#
+#     python bench_quoting.py                     # defaults
+#     python bench_quoting.py --ep-latency 0.25 --ss-latency 0.6 --orders 500 --workers 32
+#     python bench_quoting.py --cassette cassette.json   # replay recorded responses
+
+
+import argparse, contextlib, csv, io, math, os, tempfile, time, tracemalloc
+
+import fake_providers
+
+
+FROM_ADDRESS_DICT = {
+    'name': 'Name', 'company': 'company', 'street1': 'street1', 'street2': '',
+    'city': 'Costa Mesa', 'state': 'CA', 'postal_code': '92627', 'country': 'US', 'phone': '',
+}
+PARCEL_DICT_OZ = {'length': 12.4, 'width': 9.4, 'height': .5, 'weight_oz': 16, 'description': 'E-fabric'}
+# Destination ZIPs for generated orders; few enough that the cached run has repeats
+ZIPS = ['10001', '30301', '60601', '73301', '80201', '94105', '98101', '02108', '33101', '55401']
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    # nearest rank
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def to_address_dict(i):
+    return {
+        'customer_order_id': '#%d' % (1000 + i), 'sales_platform__order_id': str(i),
+        'name': 'Customer %d' % i, 'street1': '%d Main St' % (i + 1), 'street2': '',
+        'city': 'City', 'state': 'ST', 'postal_code': ZIPS[i % len(ZIPS)], 'country': 'US', 'phone': '',
+    }
+
+
+def write_orders_csv(path, n):
+    fields = ['Name', 'Id', 'Shipping Name', 'Shipping Street', 'Shipping Address2', 'Shipping City',
+              'Shipping Province', 'Shipping Zip', 'Shipping Country', 'Shipping Phone']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for i in range(n):
+            a = to_address_dict(i)
+            writer.writerow([a['customer_order_id'], a['sales_platform__order_id'], a['name'], a['street1'],
+                             a['street2'], a['city'], a['state'], a['postal_code'], a['country'], a['phone']])
+
+
+def report(name, latencies, elapsed, allocated_blocks, peak_bytes, calls, errors=0):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    print('%-22s n=%-5d %8.1f quotes/s  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  '
+          'net alloc %6.0f blocks/quote  peak %7.1fKiB  api calls %s%s' % (
+              name, n, n / elapsed if elapsed else float('inf'),
+              1000 * percentile(latencies, 50), 1000 * percentile(latencies, 95),
+              1000 * percentile(latencies, 99),
+              allocated_blocks / n if n else 0, peak_bytes / 1024.0,
+              sum(calls.values()), ' errors %d' % errors if errors else ''))
+
+
+@contextlib.contextmanager
+def measure(fakes):
+    """Silences the quoting prints; yields a dict filled with elapsed / allocation stats"""
+    result = {}
+    fakes.reset_counters()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield result
+    result['elapsed'] = time.perf_counter() - start
+    after = tracemalloc.take_snapshot()
+    result['peak'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result['blocks'] = sum(max(0, s.count_diff) for s in after.compare_to(before, 'filename'))
+    result['calls'] = dict(fakes.calls)
+
+
+def bench_single(quoting_engine, fakes, n, concurrent, **kwargs):
+    latencies = []
+    errors = 0
+    with measure(fakes) as m:
+        for i in range(n):
+            start = time.perf_counter()
+            try:
+                quoting_engine.pull_and_calculate_customer_facing_quote(
+                    FROM_ADDRESS_DICT, to_address_dict(i), PARCEL_DICT_OZ, concurrent=concurrent, **kwargs)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+    return latencies, m, errors
+
+
+def bench_batch(quoting_engine, fakes, n, workers, concurrent, **kwargs):
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'orders_export.csv')
+        write_orders_csv(csv_path, n)
+        latencies = []
+        pull = quoting_engine.pull_and_calculate_customer_facing_quote
+
+        def timed_pull(*args, **kw):
+            start = time.perf_counter()
+            try:
+                return pull(*args, **kw)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        quoting_engine.pull_and_calculate_customer_facing_quote = timed_pull
+        try:
+            with measure(fakes) as m:
+                records = quoting_engine.quote_orders_batch(
+                    FROM_ADDRESS_DICT, PARCEL_DICT_OZ, CSV_PATH=csv_path, max_workers=workers,
+                    output_path=os.path.join(tmp, 'quotes.jsonl'), concurrent=concurrent, **kwargs)
+        finally:
+            quoting_engine.pull_and_calculate_customer_facing_quote = pull
+    return latencies, m, sum(1 for r in records if r['status'] == 'error')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--orders', type=int, default=200)
+    parser.add_argument('--single', type=int, default=50, help='quotes for the one-at-a-time runs')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--ep-latency', type=float, default=0.05, help='seconds per EasyPost call')
+    parser.add_argument('--ss-latency', type=float, default=0.15, help='seconds per ShipStation call')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--ep-error-rate', type=float, default=0.0)
+    parser.add_argument('--ss-error-rate', type=float, default=0.0)
+    parser.add_argument('--ep-throttle-rate', type=float, default=0.0, help='share of calls refused with 429')
+    parser.add_argument('--ss-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--cassette', help='replay responses recorded with fake_providers.Recorder')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    fakes = fake_providers.install(
+        latency={'easypost': args.ep_latency, 'shipstation': args.ss_latency},
+        error_rate={'easypost': args.ep_error_rate, 'shipstation': args.ss_error_rate},
+        seed=args.seed, cassette=args.cassette, jitter=args.jitter,
+        throttle_rate={'easypost': args.ep_throttle_rate, 'shipstation': args.ss_throttle_rate})
+    import quoting_engine
+    from quote_cache import QuoteCache, AddressCache
+
+    print('latency: easypost %.3fs shipstation %.3fs (+/-%d%%), error rate: %s / %s' % (
+        args.ep_latency, args.ss_latency, 100 * args.jitter, args.ep_error_rate, args.ss_error_rate))
+    for name, concurrent in (('single sequential', False), ('single concurrent', True)):
+        latencies, m, errors = bench_single(quoting_engine, fakes, args.single, concurrent)
+        report(name, latencies, m['elapsed'], m['blocks'], m['peak'], m['calls'], errors)
+
+    for name, concurrent in (('batch', False), ('batch concurrent', True)):
+        latencies, m, errors = bench_batch(quoting_engine, fakes, args.orders, args.workers, concurrent)
+        report(name, latencies, m['elapsed'], m['blocks'], m['peak'], m['calls'], errors)
+
+    quote_cache = QuoteCache()
+    address_cache = AddressCache(':memory:')
+    # Warm: one pass over every lane
+    with contextlib.redirect_stdout(io.StringIO()):
+        bench_single(quoting_engine, fakes, len(ZIPS), False,
+                     quote_cache=quote_cache, address_cache=address_cache)
+    latencies, m, errors = bench_single(quoting_engine, fakes, args.single, False,
+                                        quote_cache=quote_cache, address_cache=address_cache)
+    report('single cached', latencies, m['elapsed'], m['blocks'], m['peak'], m['calls'], errors)
+    latencies, m, errors = bench_batch(quoting_engine, fakes, args.orders, args.workers, False,
+                                       quote_cache=quote_cache, address_cache=address_cache)
+    report('batch cached', latencies, m['elapsed'], m['blocks'], m['peak'], m['calls'], errors)
+    print('quote cache %s' % quote_cache.stats())
+    print('address cache %s' % address_cache.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+# Copyright 2019 Eric Norman
+# Local stand-ins for the EasyPost and ShipStation calls quoting_engine.py makes,
+# for benchmarks and offline runs without production keys.
+#
+# Usage, before quoting_engine is imported:
+#     import fake_providers
+#     fakes = fake_providers.install(latency={'easypost': 0.2, 'shipstation': 0.4})
+#     import quoting_engine
+#
+# Responses are synthetic (deterministic per lane and weight) unless a cassette
+# recorded against the real APIs is given, then they are replayed in call order.
+
+
+import sys, json, time, random, threading, itertools, types, zlib
+
+import provider_scheduler
+
+
+DEFAULT_LATENCY = {'easypost': 0.0, 'shipstation': 0.0}
+DEFAULT_ERROR_RATE = {'easypost': 0.0, 'shipstation': 0.0}
+DEFAULT_THROTTLE_RATE = {'easypost': 0.0, 'shipstation': 0.0}
+# Retry-After sent with an injected 429, seconds
+THROTTLE_RETRY_AFTER = '1'
+
+# Synthetic rates: (carrier, service, base $, $ per lb, est_delivery_days)
+SYNTHETIC_EP_SERVICES = [
+    ('USPS', 'First', 3.50, 0.90, 3),
+    ('USPS', 'Priority', 7.20, 1.10, 2),
+    ('USPS', 'Express', 24.00, 2.50, 1),
+    ('USPS', 'ParcelSelect', 6.80, 0.70, 5),
+    ('UPS', 'Ground', 8.10, 0.60, 4),
+    ('UPS', '2ndDayAir', 18.50, 1.80, 2),
+]
+SYNTHETIC_SS_SERVICES = [
+    ('fedex', 'fedex_ground', 'FedEx Ground', 7.60, 0.55),
+    ('fedex', 'fedex_home_delivery', 'FedEx Home Delivery', 7.90, 0.55),
+    ('fedex', 'fedex_2day', 'FedEx 2Day', 17.20, 1.70),
+    ('fedex', 'fedex_smartpost_parcel_select', 'FedEx SmartPost parcel select', 6.10, 0.50),
+]
+
+
+class FakeProviderError(Exception):
+    """Injected failure; looks like easypost.Error (http_status, http_body)"""
+
+    def __init__(self, message, http_status=500, http_body=None, http_headers=None):
+        super().__init__(message)
+        self.message = message
+        self.http_status = http_status
+        self.http_body = http_body
+        self.http_headers = http_headers or {}
+
+
+class FakeEasyPostObject(types.SimpleNamespace):
+    """Attribute access like an EasyPost object"""
+
+    def to_dict(self):
+        d = {}
+        for k, v in self.__dict__.items():
+            if isinstance(v, FakeEasyPostObject):
+                v = v.to_dict()
+            elif isinstance(v, list):
+                v = [x.to_dict() if isinstance(x, FakeEasyPostObject) else x for x in v]
+            d[k] = v
+        return d
+
+    def buy(self, rate=None, **kwargs):
+        if getattr(self, 'postage_label', None) is not None:
+            raise FakeProviderError('Shipment already purchased', http_status=422)
+        self.selected_rate = rate
+        self.postage_label = FakeEasyPostObject(
+            label_url='https://example.invalid/%s.png' % self.id, label_pdf_url=None, label_zpl_url=None)
+        self.tracking_code = 'FAKE' + self.id
+        return self
+
+    def label(self, file_format='PDF', **kwargs):
+        setattr(self.postage_label, 'label_%s_url' % file_format.lower(),
+                'https://example.invalid/%s.%s' % (self.id, file_format.lower()))
+        return self
+
+
+def _to_object(value):
+    if isinstance(value, dict):
+        return FakeEasyPostObject(**{k: _to_object(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_to_object(v) for v in value]
+    return value
+
+
+def _plain(value):
+    """EasyPost object (real or fake) -> json-able"""
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    return value
+
+
+class FakeProviders:
+    """Fake backends plus their knobs and call counters.
+
+    Args:
+        latency(dict): seconds per call, per provider
+        error_rate(dict): chance 0-1 that a call raises FakeProviderError, per provider
+        throttle_rate(dict): chance 0-1 that a call is refused with a 429 + Retry-After, per provider
+        seed(int): for the error / jitter random numbers
+        cassette(str): json file from Recorder; replay recorded responses instead of synthetic
+        jitter(float): +/- share of latency, uniformly random
+    """
+
+    def __init__(self, latency=None, error_rate=None, seed=0, cassette=None, jitter=0.0, throttle_rate=None):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.error_rate = dict(DEFAULT_ERROR_RATE, **(error_rate or {}))
+        self.throttle_rate = dict(DEFAULT_THROTTLE_RATE, **(throttle_rate or {}))
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.calls = {}
+        self._address_zip = {}  # address id -> zip, so a lane prices the same every time
+        self._shipments = {}    # id -> shipment, for Shipment.retrieve
+        self.replay = None
+        self._replay_position = {}
+        if cassette:
+            with open(cassette) as f:
+                self.replay = json.load(f)
+
+    # Provider plumbing
+
+    def _call(self, provider, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            throttle = self._random.random() < self.throttle_rate[provider]
+            fail = self._random.random() < self.error_rate[provider]
+            delay = self.latency[provider] * (1 + self.jitter * (2 * self._random.random() - 1))
+        if throttle:
+            raise FakeProviderError('injected %s 429 in %s' % (provider, name), http_status=429,
+                                    http_headers={'Retry-After': THROTTLE_RETRY_AFTER})
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise FakeProviderError('injected %s failure in %s' % (provider, name), http_status=500)
+
+    def _replayed(self, name):
+        """Next recorded response for name, cycling; None if not recorded"""
+        if self.replay is None or not self.replay.get(name):
+            return None
+        with self._lock:
+            position = self._replay_position.get(name, 0)
+            self._replay_position[name] = position + 1
+        responses = self.replay[name]
+        return responses[position % len(responses)]
+
+    def _zip_of(self, address):
+        if isinstance(address, dict):
+            return self._address_zip.get(address.get('id')) or address.get('zip') or address.get('postal_code')
+        return getattr(address, 'zip', None)
+
+    def _id(self, prefix):
+        return '%s_fake%06d' % (prefix, next(self._ids))
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = {}
+
+    # easypost
+
+    def parcel_create(self, **kwargs):
+        self._call('easypost', 'Parcel.create')
+        recorded = self._replayed('Parcel.create')
+        if recorded is not None:
+            return _to_object(recorded)
+        return FakeEasyPostObject(id=self._id('prcl'), **kwargs)
+
+    def address_create(self, **kwargs):
+        self._call('easypost', 'Address.create')
+        recorded = self._replayed('Address.create')
+        if recorded is not None:
+            return _to_object(recorded)
+        address = dict(kwargs)
+        address.pop('verify', None)
+        address.pop('verify_strict', None)
+        address.setdefault('residential', True)
+        # What verification does to the input, roughly
+        for field in ('name', 'street1', 'street2', 'city', 'state', 'company'):
+            if address.get(field):
+                address[field] = address[field].strip().upper()
+        if str(address.get('country', '')).strip().casefold() in ('us', 'usa', 'united states'):
+            address['country'] = 'US'
+        address_id = self._id('adr')
+        self._address_zip[address_id] = address.get('zip')
+        return FakeEasyPostObject(id=address_id, **address)
+
+    def customs_item_create(self, **kwargs):
+        self._call('easypost', 'CustomsItem.create')
+        recorded = self._replayed('CustomsItem.create')
+        if recorded is not None:
+            return _to_object(recorded)
+        return FakeEasyPostObject(id=self._id('cstitem'), **kwargs)
+
+    def customs_info_create(self, **kwargs):
+        self._call('easypost', 'CustomsInfo.create')
+        recorded = self._replayed('CustomsInfo.create')
+        if recorded is not None:
+            return _to_object(recorded)
+        return FakeEasyPostObject(id=self._id('cstinfo'), **kwargs)
+
+    def shipment_create(self, **kwargs):
+        self._call('easypost', 'Shipment.create')
+        recorded = self._replayed('Shipment.create')
+        if recorded is not None:
+            return _to_object(recorded)
+        shipment_id = self._id('shp')
+        parcel = kwargs.get('parcel')
+        weight_oz = float(getattr(parcel, 'weight', None) or 16)
+        lane = '%s|%s|%s' % (self._zip_of(kwargs.get('from_address')), self._zip_of(kwargs.get('to_address')), weight_oz)
+        international = 'customs_info' in kwargs
+        rates = []
+        for carrier, service, base, per_lb, days in SYNTHETIC_EP_SERVICES:
+            price = _synthetic_price(lane + service, base, per_lb, weight_oz, international)
+            rates.append(FakeEasyPostObject(
+                id=self._id('rate'), object='Rate', shipment_id=shipment_id,
+                carrier=carrier, service=service, rate='%.2f' % price, list_rate='%.2f' % price,
+                currency='USD', est_delivery_days=days + (4 if international else 0),
+                carrier_account_id='ca_fake%s' % carrier.lower()))
+        shipment = FakeEasyPostObject(
+            id=shipment_id, object='Shipment', rates=rates, messages=[], postage_label=None, **kwargs)
+        with self._lock:
+            self._shipments[shipment_id] = shipment
+        return shipment
+
+    def shipment_retrieve(self, shipment_id, **kwargs):
+        self._call('easypost', 'Shipment.retrieve')
+        return self._shipments[shipment_id]
+
+    def download_label(self, url, path):
+        """Stand-in for label_purchase.download_label"""
+        self._call('easypost', 'label download')
+        with open(path, 'wb') as f:
+            f.write(('%%PDF-1.4 %%FAKE LABEL %s\n' % url).encode())
+
+    # pack_cli.easypost_functions
+
+    def ep_generate_address_object(self, name, street1, country, postal_code, street2, city, state, phone, company):
+        return self.address_create(
+            verify=['delivery'], name=name, street1=street1, country=country, zip=postal_code,
+            street2=street2, city=city, state=state, phone=phone, company=company)
+
+    def ep_generate_parcel_object(self, parcel_dict_oz):
+        return self.parcel_create(
+            length=parcel_dict_oz['length'], width=parcel_dict_oz['width'],
+            height=parcel_dict_oz['height'], weight=parcel_dict_oz['weight_oz'])
+
+    @staticmethod
+    def ep_convert_address_object_to_dict(ep_address_object):
+        return {
+            'name': ep_address_object.name,
+            'company': getattr(ep_address_object, 'company', ''),
+            'street1': ep_address_object.street1,
+            'street2': ep_address_object.street2,
+            'city': ep_address_object.city,
+            'state': ep_address_object.state,
+            'postal_code': ep_address_object.zip,
+            'country': ep_address_object.country,
+            'phone': ep_address_object.phone,
+        }
+
+    # pack_cli.shipstation_functions
+
+    def get_quotes_for_carrier(self, customer_name, to_address_ss_object, weight_grams, carrierCode,
+                               dimensions, delivery_confirmation, from_address_ss_object, serviceCode):
+        self._call('shipstation', 'get_quotes_for_carrier')
+        recorded = self._replayed('get_quotes_for_carrier')
+        if recorded is not None:
+            return [dict(q) for q in recorded]
+        weight_oz = weight_grams / 28.349523125
+        lane = '%s|%s|%s' % (from_address_ss_object.get('postal_code'),
+                             to_address_ss_object.get('postal_code'), weight_oz)
+        international = from_address_ss_object.get('country') != to_address_ss_object.get('country')
+        quotes = []
+        for carrier, code, name, base, per_lb in SYNTHETIC_SS_SERVICES:
+            if carrierCode and carrier != carrierCode:
+                continue
+            price = _synthetic_price(lane + code, base, per_lb, weight_oz, international)
+            quotes.append({'carrierCode': carrier, 'serviceCode': code, 'serviceName': name,
+                           'shipmentCost': round(price - 0.45, 2), 'otherCost': 0.45})
+        return quotes
+
+    @staticmethod
+    def ss_generate_address_object_from_dict(address_dict):
+        return dict(address_dict)
+
+    def ss_get_fedex_shipping_label(self, *args, **kwargs):
+        self._call('shipstation', 'ss_get_fedex_shipping_label')
+        return {'shipmentId': next(self._ids), 'trackingNumber': self._id('FAKE'),
+                'labelData': 'JVBERi0xLjQKJUZBS0UgTEFCRUwK'}  # base64 '%PDF-1.4 %FAKE LABEL'
+
+
+def _synthetic_price(lane, base, per_lb, weight_oz, international):
+    """Same lane + service always prices the same, different lanes spread +/- 15%"""
+    spread = (zlib.crc32(lane.encode()) % 3000) / 10000.0 - 0.15
+    price = (base + per_lb * weight_oz / 16.0) * (1 + spread)
+    if international:
+        price = price * 3 + 10
+    return price
+
+
+def install(latency=None, error_rate=None, seed=0, cassette=None, jitter=0.0, throttle_rate=None):
+    """Put fake easypost and pack_cli modules in sys.modules; if quoting_engine is
+    already imported, point its module globals at the fakes too.
+    The stand-ins have no rate limits, so the provider scheduler's are lifted
+    (it still adapts to injected 429s).
+
+    Returns:
+        fakes(FakeProviders)
+    """
+    fakes = FakeProviders(latency, error_rate, seed, cassette, jitter, throttle_rate)
+    provider_scheduler.PROVIDER_SCHEDULER.configure({})
+
+    easypost = types.ModuleType('easypost')
+    easypost.api_key = None
+    easypost.Error = FakeProviderError
+    easypost.Parcel = types.SimpleNamespace(create=fakes.parcel_create)
+    easypost.Address = types.SimpleNamespace(create=fakes.address_create)
+    easypost.CustomsItem = types.SimpleNamespace(create=fakes.customs_item_create)
+    easypost.CustomsInfo = types.SimpleNamespace(create=fakes.customs_info_create)
+    easypost.Shipment = types.SimpleNamespace(create=fakes.shipment_create, retrieve=fakes.shipment_retrieve)
+
+    pack_cli = types.ModuleType('pack_cli')
+    pack_cli.__path__ = []
+    api_keys = types.ModuleType('pack_cli.api_keys')
+    api_keys.__path__ = []
+    secrets = types.ModuleType('pack_cli.api_keys.secrets')
+    secrets.easypost_test_api_key = 'fake_test_key'
+    secrets.easypost_production_api_key = 'fake_production_key'
+    conversions = types.ModuleType('pack_cli.conversions')
+    conversions.convert_ounces_to_grams = lambda ounces: ounces * 28.349523125
+    easypost_functions = types.ModuleType('pack_cli.easypost_functions')
+    easypost_functions.ep_generate_address_object = fakes.ep_generate_address_object
+    easypost_functions.ep_convert_address_object_to_dict = fakes.ep_convert_address_object_to_dict
+    easypost_functions.ep_generate_parcel_object = fakes.ep_generate_parcel_object
+    shipstation_functions = types.ModuleType('pack_cli.shipstation_functions')
+    shipstation_functions.get_quotes_for_carrier = fakes.get_quotes_for_carrier
+    shipstation_functions.ss_generate_address_object_from_dict = fakes.ss_generate_address_object_from_dict
+    shipstation_functions.ss_get_fedex_shipping_label = fakes.ss_get_fedex_shipping_label
+    pack_cli.api_keys = api_keys
+    api_keys.secrets = secrets
+    pack_cli.conversions = conversions
+    pack_cli.easypost_functions = easypost_functions
+    pack_cli.shipstation_functions = shipstation_functions
+
+    modules = {
+        'easypost': easypost,
+        'pack_cli': pack_cli,
+        'pack_cli.api_keys': api_keys,
+        'pack_cli.api_keys.secrets': secrets,
+        'pack_cli.conversions': conversions,
+        'pack_cli.easypost_functions': easypost_functions,
+        'pack_cli.shipstation_functions': shipstation_functions,
+    }
+    sys.modules.update(modules)
+
+    quoting_engine = sys.modules.get('quoting_engine')
+    if quoting_engine is not None:
+        quoting_engine.easypost = easypost
+        for module in (conversions, easypost_functions, shipstation_functions):
+            for name, value in vars(module).items():
+                if not name.startswith('_') and hasattr(quoting_engine, name):
+                    setattr(quoting_engine, name, value)
+    return fakes
+
+
+class Recorder:
+    """Record real provider responses to a cassette for FakeProviders to replay.
+
+    Wraps the real easypost / pack_cli calls in place; call save() when done.
+
+        recorder = fake_providers.Recorder('cassette.json')
+        import quoting_engine
+        recorder.attach(quoting_engine)
+        ... quote ...
+        recorder.save()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        self._lock = threading.Lock()
+
+    def _wrap(self, name, function):
+        def recorded(*args, **kwargs):
+            response = function(*args, **kwargs)
+            if name == 'get_quotes_for_carrier':
+                plain = [dict(q) for q in response]
+            else:
+                plain = _plain(response)
+            with self._lock:
+                self.responses.setdefault(name, []).append(plain)
+            return response
+        return recorded
+
+    def attach(self, quoting_engine):
+        easypost = quoting_engine.easypost
+        for name in ('Parcel', 'Address', 'CustomsItem', 'CustomsInfo', 'Shipment'):
+            cls = getattr(easypost, name)
+            cls.create = staticmethod(self._wrap(name + '.create', cls.create))
+        quoting_engine.get_quotes_for_carrier = self._wrap(
+            'get_quotes_for_carrier', quoting_engine.get_quotes_for_carrier)
+
+    def save(self):
+        with self._lock:
+            with open(self.path, 'w') as f:
+                json.dump(self.responses, f, default=str, indent=1)
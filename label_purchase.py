@@ -0,0 +1,370 @@
+# Copyright 2019 Eric Norman
+# Bulk label purchase for the winning quotes of a batch (quoting_engine.stream_quotes
+# records): EasyPost labels bought concurrently, each written to disk as soon as it is
+# bought. Orders quoted on ShipStation are reported not_bought and left to the ShipStation
+# account; their labels are not bought here (yet).
+# A sqlite ledger keyed per order means running a batch again (after a crash, a timeout,
+# some failures) never buys an order twice.
+#
+#     python label_purchase.py quotes.jsonl --labels labels/ --out labels.jsonl
+#
+# Ledger status per order:
+#     pending   claimed by a buyer (owner) until its lease ends; once the purchase is
+#               sent, outcome not known yet (or never learned: needs review)
+#     bought    label bought; tracking code, label url (a label file that failed to
+#               save is downloaded again), label file
+#     failed    refused by the provider, nothing bought; the next run tries again
+# A pending order whose lease is still running is another buyer's (thread or process):
+# it is reported in_progress and left alone.
+
+
+import argparse, json, os, re, sqlite3, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import provider_transport
+import quoting_engine
+from provider_scheduler import error_status
+
+
+LABEL_EXTENSIONS = {'PDF': 'pdf', 'ZPL': 'zpl', 'PNG': 'png'}
+# Bytes per write when streaming a label to disk
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+# Seconds a claim keeps other buyers off an order; well over one purchase + download.
+# A run that dies holds its orders this long
+LEASE_SECONDS = 15 * 60
+
+
+def idempotency_key(record):
+    """One label per order parcel, whatever service was quoted"""
+    if record.get('idempotency_key'):
+        return record['idempotency_key']
+    key = 'order:%s:%s' % (record.get('sales_platform__order_id'), record['customer_order_id'])
+    # Single parcel orders keep the key they always had
+    if record.get('parcel_count', 1) > 1:
+        key += ':%d' % record['parcel_index']
+    return key
+
+
+class LabelLedger:
+    """What has been bought, per idempotency key; sqlite so it survives the process.
+
+    Args:
+        path(str): sqlite file
+    """
+
+    FIELDS = ['key', 'customer_order_id', 'status', 'provider', 'shipment_id', 'rate_id',
+              'tracking_code', 'label_url', 'label_path', 'error', 'updated',
+              'owner', 'lease_until']
+    # Added after the first ledgers were written
+    _NEW_COLUMNS = {'owner': 'TEXT', 'lease_until': 'REAL'}
+
+    def __init__(self, path='label_ledger.sqlite3'):
+        self.path = path
+        self._lock = threading.Lock()
+        # Autocommit; claim() runs its own transaction, so other processes see claims at once
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, customer_order_id TEXT, '
+            'status TEXT, provider TEXT, shipment_id TEXT, rate_id TEXT, tracking_code TEXT, '
+            'label_url TEXT, label_path TEXT, error TEXT, updated REAL, '
+            'owner TEXT, lease_until REAL)')
+        columns = set(row[1] for row in self._db.execute('PRAGMA table_info(labels)'))
+        for column, column_type in self._NEW_COLUMNS.items():
+            if column not in columns:
+                self._db.execute('ALTER TABLE labels ADD COLUMN %s %s' % (column, column_type))
+
+    def _get(self, key):
+        row = self._db.execute(
+            'SELECT %s FROM labels WHERE key = ?' % ', '.join(self.FIELDS), (key,)).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def claim(self, key, customer_order_id, owner, lease_seconds=LEASE_SECONDS):
+        """Take the order for buying, unless a buyer already has. Atomic across threads
+        and processes sharing the file.
+
+        Args:
+            owner(str): unique per purchase attempt
+            lease_seconds(float): how long the claim keeps other buyers off
+
+        Returns:
+            entry(dict): None if newly claimed; otherwise the ledger entry: 'bought',
+                'pending' with owner set to this owner (an earlier run's, its lease over,
+                taken over to reconcile), or 'pending' with another owner (in progress)
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                entry = self._get(key)
+                if entry is None or entry['status'] == 'failed':
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO labels (key, customer_order_id, status, owner, lease_until, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (key, customer_order_id, 'pending', owner, now + lease_seconds, now))
+                    entry = None
+                elif entry['status'] == 'pending' and (entry['lease_until'] or 0) <= now:
+                    self._db.execute('UPDATE labels SET owner = ?, lease_until = ?, updated = ? WHERE key = ?',
+                                     (owner, now + lease_seconds, now, key))
+                    entry = self._get(key)
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            return entry
+
+    def update(self, key, owner=None, **fields):
+        """Set fields of the entry; with owner, only while that owner holds it.
+
+        Returns:
+            updated(bool)
+        """
+        fields['updated'] = time.time()
+        where = 'key = ?'
+        values = list(fields.values()) + [key]
+        if owner is not None:
+            where += ' AND owner = ?'
+            values.append(owner)
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE labels SET %s WHERE %s' % (', '.join('%s = ?' % f for f in fields), where), values)
+            return cursor.rowcount > 0
+
+    def stats(self):
+        """Returns:
+            stats(dict): status -> orders"""
+        with self._lock:
+            return dict(self._db.execute('SELECT status, COUNT(*) FROM labels GROUP BY status').fetchall())
+
+
+def download_label(url, path):
+    """Stream a label file to path"""
+    session = provider_transport.get_session('easypost')
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+
+
+def _label_path(label_dir, record, label_format):
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', str(record['customer_order_id'])).strip('_') or 'order'
+    if record.get('parcel_count', 1) > 1:
+        name += '-%d' % (record['parcel_index'] + 1)
+    return os.path.join(label_dir, '%s.%s' % (name, LABEL_EXTENSIONS[label_format]))
+
+
+def _refused(e):
+    """Provider answered no (4xx but not timeout): nothing was bought"""
+    status = error_status(e)
+    return status is not None and 400 <= status < 500 and status != 408
+
+
+class LabelBuyer:
+    """Buys and saves the label of one quoted order at a time; thread safe.
+
+    Args:
+        ledger(LabelLedger)
+        label_dir(str): label files go here, named after the order
+        label_format(str): 'PDF', 'ZPL' or 'PNG'
+        download: (url, path), writes the label file; download_label by default
+    """
+
+    def __init__(self, ledger, label_dir, label_format='PDF', download=download_label):
+        self.ledger = ledger
+        self.label_dir = label_dir
+        self.label_format = label_format
+        self.download = download
+        os.makedirs(label_dir, exist_ok=True)
+
+    def _result(self, record, status, entry=None, error=None):
+        entry = entry or {}
+        return {
+            'customer_order_id': record['customer_order_id'],
+            'sales_platform__order_id': record.get('sales_platform__order_id'),
+            'parcel_index': record.get('parcel_index', 0),
+            'status': status,
+            'provider': entry.get('provider'),
+            'tracking_code': entry.get('tracking_code'),
+            'label_path': entry.get('label_path'),
+            'error': error or entry.get('error'),
+        }
+
+    def _bought_result(self, record, status, entry):
+        """'bought' / 'already_bought' if the label file is on disk, 'label_not_saved' if
+        not (the next run writes it again)"""
+        return self._result(record, status if entry['label_path'] else 'label_not_saved', entry)
+
+    def buy(self, record):
+        """Buy the label of a 'quoted' record unless the ledger says it was already,
+        or another buyer holds it.
+
+        Returns:
+            result(dict): customer_order_id, parcel_index, status ('bought', 'already_bought',
+                'label_not_saved', 'in_progress', 'needs_review', 'failed', 'not_bought'
+                for ShipStation quotes), provider, tracking_code, label_path, error
+        """
+        key = idempotency_key(record)
+        quote = record['quote']
+        order = record['present_to_customer']
+        if quote['source'].startswith('shipstation/'):
+            return self._result(record, 'not_bought', error='ShipStation quote, buy the label in ShipStation')
+        owner = uuid.uuid4().hex
+        entry = self.ledger.claim(key, record['customer_order_id'], owner)
+        ep_shipment = rate_id = None
+        if entry is not None:
+            if entry['status'] == 'bought':
+                if entry['label_path'] is None and entry['label_url']:
+                    entry = self._save_label(key, record, entry)
+                return self._bought_result(record, 'already_bought', entry)
+            if entry['owner'] != owner:
+                return self._result(record, 'in_progress', entry, 'another buyer holds this order')
+            # pending and its lease over: an earlier run stopped before sending anything
+            # (no provider yet), or sent the purchase and never heard back
+            if entry['provider'] is not None:
+                ep_shipment, rate_id, entry = self._reconcile(key, record, entry)
+                if entry['status'] == 'bought':
+                    return self._bought_result(record, 'already_bought', entry)
+                if ep_shipment is None:
+                    self.ledger.update(key, owner, lease_until=0)
+                    return self._result(record, 'needs_review', entry,
+                                        'purchase outcome unknown, check the %s account' % entry['provider'])
+        from_address_dict, to_address_dict = order['from'], order['to']
+        try:
+            if not quote['source'].startswith('easypost/'):
+                raise ValueError('unknown quote source %r' % quote['source'])
+            if ep_shipment is None:
+                ep_shipment, rate_id = quoting_engine.ep_shipment_for_quote(
+                    quote, from_address_dict, to_address_dict, order['parcel'])
+            # Recorded before the money is spent, so a crash after can be reconciled; the lease
+            # starts over for the purchase, unless another buyer has taken the order meanwhile
+            held = self.ledger.update(key, owner, provider='easypost', shipment_id=ep_shipment.id,
+                                      rate_id=rate_id, lease_until=time.time() + LEASE_SECONDS)
+        except Exception as e:
+            self.ledger.update(key, owner, status='failed', error='%s: %s' % (type(e).__name__, e))
+            return self._result(record, 'failed', self.ledger.get(key))
+        if not held:
+            return self._result(record, 'in_progress', self.ledger.get(key), 'another buyer took this order over')
+        try:
+            label = quoting_engine.create_shipping_label(
+                quote, from_address_dict, to_address_dict, order['parcel'], self.label_format, ep_shipment, rate_id)
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            if _refused(e):
+                self.ledger.update(key, status='failed', error=error)
+                return self._result(record, 'failed', self.ledger.get(key))
+            # May have gone through; stays pending, the next run reconciles
+            self.ledger.update(key, error=error, lease_until=0)
+            return self._result(record, 'needs_review', self.ledger.get(key))
+        self.ledger.update(key, status='bought', provider=label['provider'], shipment_id=str(label['shipment_id']),
+                           tracking_code=label['tracking_code'], label_url=label['label_url'], error=None)
+        entry = self._save_label(key, record, self.ledger.get(key))
+        return self._bought_result(record, 'bought', entry)
+
+    def _reconcile(self, key, record, entry):
+        """Pending EasyPost purchase: the shipment knows whether it was bought.
+
+        Returns:
+            tuple[0] ep_shipment(EP Object): not bought, safe to buy; None if bought or unknown
+            tuple[1] rate_id(str)
+            tuple[2] entry(dict)
+        """
+        if entry['provider'] != 'easypost' or not entry['shipment_id']:
+            return None, None, entry
+        ep_shipment = quoting_engine._provider_call(
+            'easypost', 'Shipment.retrieve', quoting_engine.easypost.Shipment.retrieve, entry['shipment_id'])
+        if getattr(ep_shipment, 'postage_label', None) is None:
+            return ep_shipment, entry['rate_id'], entry
+        label_url = quoting_engine.ep_label_url(ep_shipment, self.label_format)
+        self.ledger.update(key, status='bought', tracking_code=ep_shipment.tracking_code, label_url=label_url,
+                           error=None)
+        return None, None, self._save_label(key, record, self.ledger.get(key))
+
+    def _save_label(self, key, record, entry):
+        """Download the entry's label file (temp file, then renamed) and record where"""
+        path = _label_path(self.label_dir, record, self.label_format)
+        try:
+            self.download(entry['label_url'], path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            # Bought either way; the next run writes it again
+            self.ledger.update(key, error='label not saved: %s: %s' % (type(e).__name__, e))
+            return self.ledger.get(key)
+        self.ledger.update(key, label_path=path, error=None)
+        return self.ledger.get(key)
+
+
+def iter_label_purchases(records, buyer, max_workers=8, max_in_flight=None):
+    """Buy the labels of the 'quoted' records (others are passed over), yielding
+    each result as soon as its label is on disk.
+
+    Args:
+        records: iter_accounting records, e.g. read back from the quotes JSONL
+        buyer(LabelBuyer)
+        max_workers(int): labels bought at the same time
+        max_in_flight(int): default 2 * max_workers
+
+    Yields:
+        result(dict): see LabelBuyer.buy
+    """
+    max_in_flight = max_in_flight or 2 * max_workers
+    records = (r for r in records if r.get('status') == 'quoted')
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='label') as pool:
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                record = next(records, None)
+                if record is None:
+                    exhausted = True
+                    break
+                in_flight[pool.submit(buyer.buy, record)] = record
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = in_flight.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield buyer._result(record, 'needs_review', error='%s: %s' % (type(e).__name__, e))
+
+
+def iter_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Buy the labels of a quoted batch')
+    parser.add_argument('quotes', help='JSONL from quoting_engine.stream_quotes / quote_orders_batch')
+    parser.add_argument('--labels', default='labels', help='directory for the label files')
+    parser.add_argument('--out', help='JSONL, one result per order')
+    parser.add_argument('--ledger', default='label_ledger.sqlite3')
+    parser.add_argument('--format', default='PDF', choices=sorted(LABEL_EXTENSIONS))
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    ledger = LabelLedger(args.ledger)
+    buyer = LabelBuyer(ledger, args.labels, args.format)
+    output_file = open(args.out, 'w') if args.out else None
+    counts = {}
+    try:
+        results = iter_label_purchases(iter_jsonl(args.quotes), buyer, args.workers)
+        for result in quoting_engine.write_jsonl(results, output_file):
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+    finally:
+        if output_file is not None:
+            output_file.close()
+    print('Labels: %s' % ', '.join('%d %s' % (n, status) for status, n in sorted(counts.items())))
+    print('Ledger: %s' % ledger.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+# Copyright 2019 Eric Norman
+# Rate limiting and retries under every provider call in quoting_engine.py.
+# Per provider: a token bucket whose rate adapts (slower on 429, creeping back up
+# on success, Retry-After honored), a cap on requests in flight, and jittered
+# exponential backoff for throttling and transient failures.
+# A call with a deadline never waits (for a token, a slot or a backoff) past it:
+# it raises DeadlineExceeded instead, without taking the token.
+#
+#     PROVIDER_SCHEDULER.call('easypost', 'Shipment.create', attempt)
+#     with PROVIDER_SCHEDULER.deadline(time.monotonic() + 5):
+#         ... provider calls on this thread ...
+#     PROVIDER_SCHEDULER.stats()
+
+
+import contextlib, email.utils, random, threading, time
+
+from quote_metrics import METRICS
+
+
+# Statuses worth another try; anything else (400 bad address, 401, ...) raises at once
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+THROTTLED_STATUS = 429
+
+# requests/second to start at, burst size, ceiling the rate may climb back to,
+# requests in flight at once.
+# NOTE: ShipStation documents 40 requests/minute per key; EasyPost does not publish one
+PROVIDER_LIMITS = {
+    'easypost': {'rate': 20.0, 'burst': 20, 'max_rate': 100.0, 'max_in_flight': 32},
+    'shipstation': {'rate': 40 / 60.0, 'burst': 40, 'max_rate': 40 / 60.0, 'max_in_flight': 8},
+}
+# For providers without limits (e.g. the local stand-ins in fake_providers.py)
+UNLIMITED = {'rate': float('inf'), 'burst': 1, 'max_rate': float('inf'), 'max_in_flight': 1024}
+# ... until it throttles us; then it gets a real bucket from this rate
+UNLIMITED_THROTTLED_RATE = 20.0
+
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.25     # seconds, doubled every attempt
+BACKOFF_MAX = 20.0      # seconds
+# On a 429 the rate is multiplied by this; each success adds RATE_INCREASE of the ceiling back
+RATE_DECREASE = 0.5
+RATE_INCREASE = 0.01
+
+
+class DeadlineExceeded(TimeoutError):
+    """A provider call could not start before its caller's deadline; nothing was sent"""
+
+
+class ProviderLimiter:
+    """Token bucket + in flight cap for one provider (AIMD rate).
+
+    Args:
+        rate(float): requests per second to start at
+        burst(int): tokens the bucket holds
+        max_rate(float): the rate never climbs above this
+        max_in_flight(int): requests out at the same time
+        min_rate(float): the rate never drops below this
+    """
+
+    def __init__(self, rate, burst, max_rate, max_in_flight, min_rate=0.1):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, rate)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def _reserve(self, deadline=None):
+        """Take a token; returns seconds to wait before using it, or None (no token
+        taken) if that wait would run past deadline"""
+        with self._lock:
+            now = time.monotonic()
+            if self.rate == float('inf'):
+                wait = max(0.0, self._blocked_until - now)
+                if deadline is not None and now + wait > deadline:
+                    return None
+                return wait
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            wait = max(wait, self._blocked_until - now)
+            if deadline is not None and now + wait > deadline:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def _refund(self):
+        with self._lock:
+            if self.rate != float('inf'):
+                self._tokens = min(self.burst, self._tokens + 1)
+
+    def acquire(self, sleep=time.sleep, deadline=None):
+        """Wait for a token and an in flight slot.
+
+        Args:
+            deadline(float): time.monotonic() to give up at, None to wait as long as it takes
+        """
+        wait = self._reserve(deadline)
+        if wait is None:
+            raise DeadlineExceeded('no token before the deadline')
+        if wait > 0:
+            sleep(wait)
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not self._in_flight.acquire(timeout=timeout):
+            self._refund()
+            raise DeadlineExceeded('no free slot before the deadline')
+
+    def release(self):
+        self._in_flight.release()
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE * self.max_rate)
+
+    def throttled(self, retry_after=None):
+        """Provider said slow down: cut the rate, empty the bucket and, with
+        Retry-After, hold every caller until then"""
+        with self._lock:
+            now = time.monotonic()
+            if self.rate == float('inf'):
+                self.rate = self.max_rate = UNLIMITED_THROTTLED_RATE
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = now
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+
+def error_status(e):
+    """HTTP status of a provider exception, None for network errors / unknown.
+    easypost.Error has http_status; requests.HTTPError has a response."""
+    status = getattr(e, 'http_status', None)
+    if status is None and getattr(e, 'response', None) is not None:
+        status = getattr(e.response, 'status_code', None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(e):
+    """Retry-After of a provider exception in seconds (delta or HTTP date), None if absent"""
+    headers = getattr(e, 'http_headers', None)
+    if headers is None and getattr(e, 'response', None) is not None:
+        headers = getattr(e.response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(e):
+    """Throttled, a transient 5xx, or a network error (no status at all)"""
+    status = error_status(e)
+    if status is None:
+        return isinstance(e, (OSError, TimeoutError))
+    return status in RETRYABLE_STATUS
+
+
+class ProviderScheduler:
+    """Runs provider calls under each provider's limiter, retrying what is retryable.
+
+    Args:
+        limits(dict): provider -> kwargs of ProviderLimiter; providers not in it are unlimited
+        max_attempts(int): tries per call, first one included
+        sleep: time.sleep, replaceable for tests
+    """
+
+    def __init__(self, limits=None, max_attempts=MAX_ATTEMPTS, sleep=time.sleep):
+        self.limits = dict(PROVIDER_LIMITS if limits is None else limits)
+        self.max_attempts = max_attempts
+        self.sleep = sleep
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def deadline(self, deadline):
+        """Calls on this thread inside the block give up at deadline (time.monotonic()),
+        for calls made deep inside helpers that do not take one"""
+        previous = getattr(self._local, 'deadline', None)
+        self._local.deadline = deadline
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def configure(self, limits):
+        """Replace the limits; limiters start over from them"""
+        with self._lock:
+            self.limits = dict(limits)
+            self._limiters = {}
+
+    def limiter(self, provider):
+        limiter = self._limiters.get(provider)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(provider)
+                if limiter is None:
+                    limiter = self._limiters[provider] = ProviderLimiter(
+                        **self.limits.get(provider, UNLIMITED))
+        return limiter
+
+    def backoff(self, attempt, retry_after=None):
+        """Full jitter: uniform 0..BACKOFF_BASE * 2^attempt (capped), at least Retry-After"""
+        delay = self._random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, provider, call, attempt, retry=True, deadline=None):
+        """attempt() under the provider's limits.
+
+        Args:
+            provider(str): 'easypost' or 'shipstation'
+            call(str): API call name for the counters
+            attempt: makes the request, no arguments
+            retry(bool): False for calls that must not be sent twice (e.g. buying a label);
+                only a 429, which the provider refused, is retried then
+            deadline(float): time.monotonic() to give up at; default the one set with
+                deadline(), if any
+
+        Returns:
+            what attempt returned; raises its last exception when out of attempts or
+            when the next attempt could not start before deadline (DeadlineExceeded
+            if there was no attempt at all)
+        """
+        limiter = self.limiter(provider)
+        if deadline is None:
+            deadline = getattr(self._local, 'deadline', None)
+        for attempt_number in range(self.max_attempts):
+            try:
+                limiter.acquire(self.sleep, deadline)
+            except DeadlineExceeded:
+                METRICS.count('api_deadline_exceeded', provider=provider, call=call)
+                if attempt_number:
+                    raise last_error
+                raise
+            try:
+                result = attempt()
+            except Exception as e:
+                status = error_status(e)
+                retry_after = retry_after_seconds(e)
+                if status == THROTTLED_STATUS:
+                    limiter.throttled(retry_after)
+                    METRICS.count('api_throttled', provider=provider, call=call)
+                    retryable = True
+                else:
+                    retryable = retry and is_retryable(e)
+                if not retryable or attempt_number + 1 >= self.max_attempts:
+                    raise
+                last_error = e
+            else:
+                limiter.succeeded()
+                return result
+            finally:
+                limiter.release()
+            delay = self.backoff(attempt_number, retry_after)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                METRICS.count('api_deadline_exceeded', provider=provider, call=call)
+                raise last_error
+            METRICS.count('api_retries', provider=provider, call=call, status=status or 'network')
+            self.sleep(delay)
+
+    def stats(self):
+        """Returns:
+            stats(dict): provider -> current rate (requests/second)"""
+        with self._lock:
+            return {provider: round(limiter.rate, 3) for provider, limiter in self._limiters.items()}
+
+
+# Default instance quoting_engine.py sends every provider call through
+PROVIDER_SCHEDULER = ProviderScheduler()
@@ -0,0 +1,140 @@
+# Copyright 2019 Eric Norman
+# One keep-alive requests.Session per provider, with a connection pool per API host,
+# shared by every quote and thread so connections (and their TLS handshakes) get reused.
+#
+#     provider_transport.install(easypost, shipstation_functions, pool_size=32)
+#     provider_transport.pool_stats()   # connections opened vs requests sent, per host
+#
+# NOTE: requests/urllib3 speak HTTP/1.1 only: keep-alive, no pipelining, no HTTP/2.
+# Keep-alive is what saves the handshake; a pool as big as the number of
+# threads quoting at once means no request waits for or throws away a connection.
+
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+PROVIDER_HOSTS = {
+    'easypost': ('https://api.easypost.com',),
+    'shipstation': ('https://ssapi.shipstation.com',),
+}
+# Connections kept open per host; at least the number of concurrent provider calls
+POOL_SIZE = 32
+# Retries of failed connects only (urllib3 does not retry a request it has sent)
+CONNECT_RETRIES = 2
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def build_session(provider, pool_size=POOL_SIZE):
+    """Session with a pool of pool_size keep-alive connections per host of provider.
+
+    Args:
+        provider(str): key of PROVIDER_HOSTS
+
+    Returns:
+        session(requests.Session)
+    """
+    session = requests.Session()
+    for host in PROVIDER_HOSTS[provider]:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=CONNECT_RETRIES)
+        session.mount(host, adapter)
+    return session
+
+
+def get_session(provider, pool_size=POOL_SIZE):
+    """Shared session for provider, built on first use"""
+    session = _SESSIONS.get(provider)
+    if session is None:
+        with _SESSIONS_LOCK:
+            session = _SESSIONS.get(provider)
+            if session is None:
+                session = _SESSIONS[provider] = build_session(provider, pool_size)
+    return session
+
+
+class _SessionRequests:
+    """Stands in for the requests module inside a client module:
+    requests.get / post / ... go through the shared session, everything else
+    (exceptions, codes, ...) is the real module."""
+
+    def __init__(self, session):
+        self._session = session
+
+    def request(self, method, url, **kwargs):
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self._session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._session.post(url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._session.put(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._session.delete(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def install(easypost_module=None, shipstation_module=None, pool_size=POOL_SIZE):
+    """Route the provider clients through the shared sessions.
+
+    EasyPost's client sends everything through its module level requests_session;
+    the ShipStation helpers call requests.get / post, so their module's requests
+    is swapped for one bound to the session. A module without either is left alone
+    (e.g. the stand-ins in fake_providers.py).
+
+    Args:
+        easypost_module(module): easypost
+        shipstation_module(module): pack_cli.shipstation_functions
+        pool_size(int): connections kept open per host
+
+    Returns:
+        installed(list of str): providers now on a shared session
+    """
+    installed = []
+    if easypost_module is not None and hasattr(easypost_module, 'requests_session'):
+        easypost_module.requests_session = get_session('easypost', pool_size)
+        installed.append('easypost')
+    if shipstation_module is not None and getattr(shipstation_module, 'requests', None) is requests:
+        shipstation_module.requests = _SessionRequests(get_session('shipstation', pool_size))
+        installed.append('shipstation')
+    return installed
+
+
+def pool_stats():
+    """Returns:
+        stats(dict): provider -> host -> connections opened, requests sent;
+            requests much larger than connections means keep-alive is working"""
+    stats = {}
+    with _SESSIONS_LOCK:
+        sessions = dict(_SESSIONS)
+    for provider, session in sessions.items():
+        for prefix, adapter in session.adapters.items():
+            if prefix not in PROVIDER_HOSTS[provider]:
+                continue
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats.setdefault(provider, {})[pool.host] = {
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                }
+    return stats
+
+
+def close():
+    """Close every pooled connection; the next request opens new ones"""
+    with _SESSIONS_LOCK:
+        for session in _SESSIONS.values():
+            session.close()
+        _SESSIONS.clear()
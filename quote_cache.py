@@ -0,0 +1,285 @@
+# Copyright 2019 Eric Norman
+# Caches in front of the provider APIs used by quoting_engine.py.
+# Everything stored here is plain dicts (json), never EasyPost objects,
+# so nothing served from a cache can be used to buy a label.
+
+
+import json, sqlite3, threading, time
+from collections import OrderedDict
+
+
+def quote_cache_key(from_address_dict, to_address_dict, parcel_dict_oz, excluded=()):
+    """Lane + parcel profile + exclusions; everything else on the addresses
+    (name, street) does not change the rates.
+
+    Returns:
+        key(str)
+    """
+    if 'predefined_package' in parcel_dict_oz:
+        parcel_profile = [parcel_dict_oz['predefined_package'], parcel_dict_oz['weight_oz']]
+    else:
+        parcel_profile = [parcel_dict_oz['length'], parcel_dict_oz['width'],
+                          parcel_dict_oz['height'], parcel_dict_oz['weight_oz']]
+    # Insurance changes the comparison quote
+    parcel_profile.append(parcel_dict_oz.get('insurance_value', 0))
+    return json.dumps([
+        from_address_dict['postal_code'].strip().casefold(),
+        from_address_dict['country'].strip().casefold(),
+        to_address_dict['postal_code'].strip().casefold(),
+        to_address_dict['country'].strip().casefold(),
+        parcel_profile,
+        sorted(e.casefold() for e in excluded),
+    ])
+
+
+class QuoteCache:
+    """TTL + LRU cache of quote results, optionally backed by a sqlite file.
+
+    Values are whatever json can hold; entries older than ttl_seconds are misses.
+    Memory holds at most max_entries, least recently used are evicted first
+    (they stay on disk until they expire).
+
+    Args:
+        ttl_seconds(float): how long a quote is good for
+        max_entries(int): in memory entries
+        path(str): sqlite file to persist to, None for memory only
+    """
+
+    def __init__(self, ttl_seconds=4 * 3600, max_entries=10000, path=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()   # key -> (created, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS quotes (key TEXT PRIMARY KEY, created REAL, value TEXT)')
+            self._db.commit()
+
+    def get(self, key):
+        """Returns:
+            value, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    'SELECT created, value FROM quotes WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+                    self._store(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now - entry[0] > self.ttl_seconds:
+                self.expired += 1
+                self.misses += 1
+                del self._entries[key]
+                if self._db is not None:
+                    self._db.execute('DELETE FROM quotes WHERE key = ?', (key,))
+                    self._db.commit()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        entry = (time.time(), value)
+        with self._lock:
+            self._store(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO quotes (key, created, value) VALUES (?, ?, ?)',
+                    (key, entry[0], json.dumps(value)))
+                self._db.commit()
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM quotes')
+                self._db.commit()
+
+    def stats(self):
+        """Returns:
+            stats(dict): hits, misses, hit_rate, evictions, expired, size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expired': self.expired,
+                'size': len(self._entries),
+            }
+
+
+ADDRESS_FIELDS = ['name', 'company', 'street1', 'street2', 'city', 'state', 'postal_code', 'country', 'phone']
+
+
+def address_cache_key(address_dict):
+    """Input address normalized: case, surrounding and repeated whitespace do not matter.
+
+    Returns:
+        key(str)
+    """
+    return '|'.join(
+        ' '.join(str(address_dict.get(field) or '').split()).casefold() for field in ADDRESS_FIELDS)
+
+
+class AddressCache:
+    """Persistent input address -> verified address dict (including 'id' and
+    'residential'), in sqlite with an in memory copy for the hot from-address.
+
+    Args:
+        path(str): sqlite file, ':memory:' to not persist
+        max_age_seconds(float): re-verify addresses older than this
+    """
+
+    def __init__(self, path='address_cache.sqlite3', max_age_seconds=30 * 24 * 3600):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self._entries = {}  # key -> (created, verified_address_dict)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS addresses (key TEXT PRIMARY KEY, created REAL, verified TEXT)')
+        self._db.commit()
+
+    def get(self, address_dict):
+        """Returns:
+            verified_address_dict(dict), or None if not cached or too old"""
+        key = address_cache_key(address_dict)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                row = self._db.execute(
+                    'SELECT created, verified FROM addresses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+                    self._entries[key] = entry
+            if entry is None or time.time() - entry[0] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, address_dict, verified_address_dict):
+        key = address_cache_key(address_dict)
+        entry = (time.time(), dict(verified_address_dict))
+        with self._lock:
+            self._entries[key] = entry
+            self._db.execute(
+                'INSERT OR REPLACE INTO addresses (key, created, verified) VALUES (?, ?, ?)',
+                (key, entry[0], json.dumps(entry[1])))
+            self._db.commit()
+
+    def purge(self, max_age_seconds=None):
+        """Delete entries older than max_age_seconds (default: the cache's own).
+
+        Returns:
+            deleted(int)
+        """
+        cutoff = time.time() - (self.max_age_seconds if max_age_seconds is None else max_age_seconds)
+        with self._lock:
+            self._entries = {k: v for k, v in self._entries.items() if v[0] >= cutoff}
+            deleted = self._db.execute('DELETE FROM addresses WHERE created < ?', (cutoff,)).rowcount
+            self._db.commit()
+        return deleted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'size': len(self._entries),
+            }
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: the first caller runs the
+    function, callers arriving while it runs wait for it and get the same result
+    (or exception). Nothing is kept after the call returns; that is what the caches are for.
+
+    Results are shared, not copied; callers must not modify them.
+
+    Args:
+        retry_errors(tuple of exception classes): errors of the caller that ran the
+            function, not of the call (e.g. its own deadline ran out); a waiting caller
+            that gets one runs the call again itself instead of raising it
+    """
+
+    def __init__(self, retry_errors=()):
+        self.retry_errors = retry_errors
+        self._flights = {}  # key -> _Flight
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """function(*args, **kwargs), unless the same key is already in flight.
+
+        Returns:
+            tuple[0] result: what function returned
+            tuple[1] shared(bool): True if it was another caller's call
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                    self.calls += 1
+            if leader:
+                break
+            flight.done.wait()
+            if flight.error is not None and isinstance(flight.error, self.retry_errors):
+                continue
+            with self._lock:
+                self.shared += 1
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = function(*args, **kwargs)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        """Returns:
+            stats(dict): calls made, shared (calls saved), in_flight"""
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._flights)}
@@ -0,0 +1,395 @@
+# Copyright 2019 Eric Norman
+# Append-only columnar history of every rate quoted, for analytics and tuning
+# exclusions without spending API calls.
+# One row per rate; strings (provider, carrier, service, postal codes, countries,
+# packages) are dictionary encoded to int32 codes. Rows are buffered, then written as
+# a chunk directory of .npy files per column, read back memory-mapped.
+# One writer per directory (codes and chunk numbers are given out by the process that
+# writes them): a second one is refused; open it read_only to query meanwhile.
+#
+#     history = QuoteHistory('quote_history')
+#     pull_and_calculate_customer_facing_quote(..., quote_history=history)
+#     history.cheapest_per_lane_week()
+#     history.savings_vs_comparison()
+
+
+import atexit, fcntl, json, os, threading, time
+import numpy as np
+
+from rate_table import weight_bucket_of
+
+
+COLUMNS = {
+    'timestamp': np.float64,
+    'quote': np.int64,          # rates of one quote share it
+    'provider': np.int32,
+    'carrier': np.int32,
+    'service': np.int32,
+    'service_code': np.int32,
+    'from_postal': np.int32,
+    'to_postal': np.int32,
+    'from_country': np.int32,
+    'to_country': np.int32,
+    'package': np.int32,        # predefined_package, '' if custom
+    'weight_bucket': np.int8,   # see rate_table.weight_bucket_of
+    'weight_oz': np.float32,
+    'length': np.float32,
+    'width': np.float32,
+    'height': np.float32,
+    'rate': np.float64,
+    'list_rate': np.float64,    # NaN if unknown
+    'est_delivery_days': np.int16,  # -1 if unknown
+}
+# Dictionary each encoded column uses; from and to share theirs
+DICTIONARIES = {
+    'provider': 'provider', 'carrier': 'carrier', 'service': 'service', 'service_code': 'service_code',
+    'from_postal': 'postal', 'to_postal': 'postal', 'from_country': 'country', 'to_country': 'country',
+    'package': 'package',
+}
+# Rows held in memory before they are written as a chunk
+CHUNK_ROWS = 65536
+SECONDS_PER_WEEK = 7 * 24 * 3600
+# 1970-01-01 was a Thursday; weeks start on Monday
+_WEEK_OFFSET = 3 * 24 * 3600
+# Comparison service, picked the way quoting_engine.select_rates picks it: EasyPost,
+# this carrier, this text in the service name (so international Priority too); lower case
+COMPARISON = ('usps', 'priority')
+
+
+class _Dictionary:
+    """value <-> int32 code, codes never change once given"""
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {v: i for i, v in enumerate(self.values)}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def decode(self, codes):
+        return [self.values[c] for c in codes]
+
+
+def _postal(address_dict):
+    return address_dict['postal_code'].strip().upper()
+
+
+def _country(address_dict):
+    return address_dict['country'].strip().upper()
+
+
+def week_start(timestamp):
+    """Returns:
+        week(str): date of the Monday the UTC week starts, e.g. '2019-05-27'"""
+    week = (timestamp + _WEEK_OFFSET) // SECONDS_PER_WEEK
+    return time.strftime('%Y-%m-%d', time.gmtime(week * SECONDS_PER_WEEK - _WEEK_OFFSET))
+
+
+def _lock_writer(path):
+    """Exclusive writer lock on a history directory, held until closed (or the process exits)
+
+    Raises:
+        RuntimeError: another QuoteHistory, in this process or another, writes there
+    """
+    lock_file = open(os.path.join(path, 'writer.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError('quote history %s is already open for writing; open it read_only to query it' % path)
+    return lock_file
+
+
+class QuoteHistory:
+    """Every rate of every quote, by timestamp, lane and parcel profile.
+
+    Args:
+        path(str): directory to keep the history in, None for memory only
+        chunk_rows(int): rows buffered before a chunk is written
+        read_only(bool): query the chunks written when it was opened, next to a writer
+
+    Raises:
+        RuntimeError: path is already open for writing
+    """
+
+    def __init__(self, path=None, chunk_rows=CHUNK_ROWS, read_only=False):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.read_only = read_only
+        self._writer_lock = None
+        self._lock = threading.Lock()
+        self._dictionaries = {name: _Dictionary() for name in set(DICTIONARIES.values())}
+        self._chunks = []   # list of {column: array}, memory mapped when on disk
+        self._buffer = {column: [] for column in COLUMNS}
+        self._next_quote = 0
+        if path:
+            if not read_only:
+                os.makedirs(path, exist_ok=True)
+                self._writer_lock = _lock_writer(path)
+            self._load()
+            if not read_only:
+                # Buffered rows are not lost when a batch run exits without flush()
+                atexit.register(self.flush)
+
+    def _load(self):
+        # Chunks first: a writer saves the dictionaries before each chunk, so they cover
+        # every chunk listed before they are read
+        chunk_names = sorted(name for name in os.listdir(self.path)
+                             if name.startswith('chunk_') and not name.endswith('.tmp'))
+        dictionaries_path = os.path.join(self.path, 'dictionaries.json')
+        if os.path.exists(dictionaries_path):
+            with open(dictionaries_path) as f:
+                for name, values in json.load(f).items():
+                    self._dictionaries[name] = _Dictionary(values)
+        for name in chunk_names:
+            chunk_path = os.path.join(self.path, name)
+            self._chunks.append({
+                column: np.load(os.path.join(chunk_path, column + '.npy'), mmap_mode='r')
+                for column in COLUMNS})
+        # Late rates join earlier quotes, so the last row is not always the last quote
+        self._next_quote = max([int(chunk['quote'].max()) + 1 for chunk in self._chunks if len(chunk['quote'])] or [0])
+
+    def record(self, from_address_dict, to_address_dict, parcel_dict_oz, rates, timestamp=None, quote=None):
+        """Add one quote's rates, excluded services included.
+
+        Args:
+            rates(list of Rate): see quoting_engine.Rate
+            quote(int): add to this earlier quote (e.g. a provider that answered late)
+
+        Returns:
+            quote(int): id of the quote the rates were added to
+        """
+        if self.read_only:
+            raise RuntimeError('quote history %s is open read_only' % self.path)
+        timestamp = time.time() if timestamp is None else timestamp
+        predefined_package = parcel_dict_oz.get('predefined_package', '')
+        weight_bucket = weight_bucket_of(parcel_dict_oz)
+        with self._lock:
+            d = self._dictionaries
+            lane = (
+                d['postal'].code(_postal(from_address_dict)), d['postal'].code(_postal(to_address_dict)),
+                d['country'].code(_country(from_address_dict)), d['country'].code(_country(to_address_dict)),
+                d['package'].code(predefined_package))
+            if quote is None:
+                quote = self._next_quote
+                self._next_quote += 1
+            b = self._buffer
+            for rate in rates:
+                b['timestamp'].append(timestamp)
+                b['quote'].append(quote)
+                b['provider'].append(d['provider'].code(rate.provider))
+                b['carrier'].append(d['carrier'].code(rate.carrier))
+                b['service'].append(d['service'].code(rate.service))
+                b['service_code'].append(d['service_code'].code(rate.service_code))
+                b['from_postal'].append(lane[0])
+                b['to_postal'].append(lane[1])
+                b['from_country'].append(lane[2])
+                b['to_country'].append(lane[3])
+                b['package'].append(lane[4])
+                b['weight_bucket'].append(weight_bucket)
+                b['weight_oz'].append(parcel_dict_oz['weight_oz'])
+                b['length'].append(parcel_dict_oz.get('length', 0))
+                b['width'].append(parcel_dict_oz.get('width', 0))
+                b['height'].append(parcel_dict_oz.get('height', 0))
+                b['rate'].append(rate.rate)
+                b['list_rate'].append(rate.list_rate if rate.list_rate is not None else np.nan)
+                b['est_delivery_days'].append(rate.est_delivery_days if rate.est_delivery_days is not None else -1)
+            if len(b['quote']) >= self.chunk_rows:
+                self._flush()
+        return quote
+
+    def flush(self):
+        """Write the buffered rows as a chunk"""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Flush and let another writer open the directory"""
+        self.flush()
+        if self._writer_lock is not None:
+            atexit.unregister(self.flush)
+            self._writer_lock.close()
+            self._writer_lock = None
+
+    def _flush(self):
+        # Caller holds the lock
+        if not self._buffer['quote']:
+            return
+        chunk = {column: np.array(values, dtype=COLUMNS[column]) for column, values in self._buffer.items()}
+        self._buffer = {column: [] for column in COLUMNS}
+        if not self.path:
+            self._chunks.append(chunk)
+            return
+        # Dictionaries first: they only grow, so they are good for every chunk already written
+        dictionaries_path = os.path.join(self.path, 'dictionaries.json')
+        with open(dictionaries_path + '.tmp', 'w') as f:
+            json.dump({name: d.values for name, d in self._dictionaries.items()}, f)
+        os.replace(dictionaries_path + '.tmp', dictionaries_path)
+        chunk_path = os.path.join(self.path, 'chunk_%06d' % len(self._chunks))
+        os.makedirs(chunk_path + '.tmp', exist_ok=True)
+        for column, values in chunk.items():
+            np.save(os.path.join(chunk_path + '.tmp', column + '.npy'), values)
+        os.replace(chunk_path + '.tmp', chunk_path)
+        self._chunks.append({
+            column: np.load(os.path.join(chunk_path, column + '.npy'), mmap_mode='r') for column in COLUMNS})
+
+    def columns(self, names=None):
+        """Whole history, written and buffered, one array per column.
+
+        Returns:
+            columns(dict): column -> np.ndarray
+        """
+        names = list(COLUMNS) if names is None else names
+        with self._lock:
+            parts = self._chunks + [{
+                column: np.array(self._buffer[column], dtype=COLUMNS[column]) for column in names}]
+            return {column: np.concatenate([part[column] for part in parts]) for column in names}
+
+    def decode(self, column, codes):
+        """Codes of a dictionary encoded column -> strings"""
+        with self._lock:
+            return self._dictionaries[DICTIONARIES[column]].decode(codes)
+
+    def _service_mask(self, columns, services):
+        """Rows whose (carrier, service_code), lower case, is in services"""
+        with self._lock:
+            carriers = [c.casefold() for c in self._dictionaries['carrier'].values]
+            service_codes = [s.casefold() for s in self._dictionaries['service_code'].values]
+        carrier_code = {c: i for i, c in enumerate(carriers)}
+        mask = np.zeros(len(columns['rate']), dtype=bool)
+        for carrier, service_code in services:
+            if carrier not in carrier_code:
+                continue
+            codes = [i for i, s in enumerate(service_codes) if s == service_code]
+            mask |= (columns['carrier'] == carrier_code[carrier]) & np.isin(columns['service_code'], codes)
+        return mask
+
+    def _comparison_mask(self, columns, comparison):
+        """Rows select_rates could take as the comparison rate (see COMPARISON)"""
+        carrier, service_text = comparison
+        with self._lock:
+            providers = self._dictionaries['provider'].values
+            carriers = [c.casefold() for c in self._dictionaries['carrier'].values]
+            services = [s.casefold() for s in self._dictionaries['service'].values]
+        provider_codes = [i for i, p in enumerate(providers) if p == 'easypost']
+        carrier_codes = [i for i, c in enumerate(carriers) if c == carrier]
+        service_codes = [i for i, s in enumerate(services) if service_text in s]
+        return (np.isin(columns['provider'], provider_codes) & np.isin(columns['carrier'], carrier_codes)
+                & np.isin(columns['service'], service_codes))
+
+    def _usps_miss_quoted(self, columns):
+        """USPS rows whose rate is not the list rate; select_rates heals them to the
+        larger of the two and never picks them as the cheapest"""
+        with self._lock:
+            carrier_codes = [i for i, c in enumerate(self._dictionaries['carrier'].values) if c.casefold() == 'usps']
+        list_rate = columns['list_rate']
+        return (np.isin(columns['carrier'], carrier_codes) & ~np.isnan(list_rate)
+                & (list_rate != columns['rate']))
+
+    def cheapest_per_lane_week(self, excluded_services=()):
+        """Cheapest rate seen per lane (from / to postal code, weight bucket) per week.
+
+        Args:
+            excluded_services(set of tuple): (carrier, service_code), lower case, left out
+
+        Returns:
+            rows(list of dict): week, from_postal, to_postal, weight_bucket, carrier, service, rate, quotes
+        """
+        c = self.columns(['timestamp', 'quote', 'carrier', 'service', 'service_code',
+                          'from_postal', 'to_postal', 'weight_bucket', 'rate'])
+        keep = ~self._service_mask(c, excluded_services)
+        c = {column: values[keep] for column, values in c.items()}
+        if not len(c['rate']):
+            return []
+        week = ((c['timestamp'] + _WEEK_OFFSET) // SECONDS_PER_WEEK).astype(np.int64)
+        # Sort by group, then rate: the first row of each group is its cheapest
+        order = np.lexsort((c['rate'], c['weight_bucket'], c['to_postal'], c['from_postal'], week))
+        groups = np.stack([week, c['from_postal'], c['to_postal'], c['weight_bucket']], axis=1)[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = np.any(groups[1:] != groups[:-1], axis=1)
+        starts = np.flatnonzero(first)
+        # Quotes per group: distinct quote ids in it
+        quote_first = np.ones(len(order), dtype=bool)
+        quote_sorted = np.lexsort((c['quote'][order], np.cumsum(first)))
+        q = c['quote'][order][quote_sorted]
+        g = np.cumsum(first)[quote_sorted]
+        quote_first[1:] = (q[1:] != q[:-1]) | (g[1:] != g[:-1])
+        quotes = np.bincount(g[quote_first] - 1, minlength=len(starts))
+        cheapest = order[starts]
+        from_postal = self.decode('from_postal', c['from_postal'][cheapest])
+        to_postal = self.decode('to_postal', c['to_postal'][cheapest])
+        carrier = self.decode('carrier', c['carrier'][cheapest])
+        service = self.decode('service', c['service'][cheapest])
+        return [{
+            'week': week_start(week[i] * SECONDS_PER_WEEK - _WEEK_OFFSET),
+            'from_postal': from_postal[n],
+            'to_postal': to_postal[n],
+            'weight_bucket': int(c['weight_bucket'][i]),
+            'carrier': carrier[n],
+            'service': service[n],
+            'rate': float(c['rate'][i]),
+            'quotes': int(quotes[n]),
+        } for n, i in enumerate(cheapest)]
+
+    def savings_vs_comparison(self, excluded_services=(), comparison=COMPARISON):
+        """Per lane (from / to postal code, weight bucket): how much the cheapest rate
+        of each quote saved against the comparison service of the same quote.
+        Quotes without the comparison rate are left out.
+
+        Args:
+            excluded_services(set of tuple): (carrier, service_code), lower case, never cheapest
+            comparison(tuple): (carrier, text in the service name), lower case; see COMPARISON
+
+        Returns:
+            rows(list of dict): from_postal, to_postal, weight_bucket, quotes,
+                mean_savings, total_savings, win_share (share of quotes cheaper than comparison)
+        """
+        c = self.columns(['quote', 'provider', 'carrier', 'service', 'service_code', 'from_postal', 'to_postal',
+                          'weight_bucket', 'rate', 'list_rate'])
+        if not len(c['rate']):
+            return []
+        n_quotes = int(c['quote'].max()) + 1
+        excluded = self._service_mask(c, excluded_services)
+        miss_quoted = self._usps_miss_quoted(c)
+        rate = np.where(miss_quoted, np.fmax(c['rate'], c['list_rate']), c['rate'])
+        # Like select_rates: the last matching rate of the quote (rows are in quote order)
+        is_comparison = self._comparison_mask(c, comparison) & ~excluded
+        rows = np.flatnonzero(is_comparison)
+        last_row = np.full(n_quotes, -1, dtype=np.int64)
+        np.maximum.at(last_row, c['quote'][rows], rows)
+        comparison_rate = np.where(last_row >= 0, rate[last_row], np.inf)
+        candidate = ~excluded & ~miss_quoted
+        cheapest_rate = np.full(n_quotes, np.inf)
+        np.minimum.at(cheapest_rate, c['quote'][candidate], c['rate'][candidate])
+        # Lane of each quote (same on all of its rows)
+        lane = np.full((n_quotes, 3), -1, dtype=np.int64)
+        lane[c['quote']] = np.stack([c['from_postal'], c['to_postal'], c['weight_bucket']], axis=1)
+        quoted = np.isfinite(comparison_rate) & np.isfinite(cheapest_rate)
+        if not quoted.any():
+            return []
+        savings = (comparison_rate - cheapest_rate)[quoted]
+        lanes, lane_index = np.unique(lane[quoted], axis=0, return_inverse=True)
+        lane_index = lane_index.reshape(-1)
+        quotes = np.bincount(lane_index, minlength=len(lanes))
+        total = np.bincount(lane_index, weights=savings, minlength=len(lanes))
+        wins = np.bincount(lane_index, weights=(savings > 0).astype(np.float64), minlength=len(lanes))
+        from_postal = self.decode('from_postal', lanes[:, 0])
+        to_postal = self.decode('to_postal', lanes[:, 1])
+        return [{
+            'from_postal': from_postal[i],
+            'to_postal': to_postal[i],
+            'weight_bucket': int(lanes[i, 2]),
+            'quotes': int(quotes[i]),
+            'mean_savings': round(float(total[i] / quotes[i]), 2),
+            'total_savings': round(float(total[i]), 2),
+            'win_share': round(float(wins[i] / quotes[i]), 4),
+        } for i in range(len(lanes))]
+
+    def stats(self):
+        with self._lock:
+            rows = sum(len(chunk['quote']) for chunk in self._chunks) + len(self._buffer['quote'])
+            return {'rows': rows, 'quotes': self._next_quote, 'chunks': len(self._chunks)}
@@ -0,0 +1,142 @@
+# Copyright 2019 Eric Norman
+# Stage timers and counters for the quote pipeline, with JSONL and
+# Prometheus text exporters.
+#
+#     with METRICS.stage('shipment', timings):    # timings: optional per-quote dict
+#         ...
+#     METRICS.count('api_calls', provider='easypost', call='Shipment.create')
+#     METRICS.write_prometheus('quote_metrics.prom')
+
+
+import functools, json, os, threading, time
+from contextlib import contextmanager
+
+
+# Histogram bucket upper bounds, seconds
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Metrics:
+    """Thread safe counters and per-stage latency histograms."""
+
+    def __init__(self, prefix='quote'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}  # (name, ((label, value), ...)) -> int
+            self.stages = {}    # stage -> {'count', 'sum', 'max', 'buckets'}
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, stage, seconds, timings=None):
+        """Record one stage duration; also into the per-quote timings dict if given
+        (a stage that runs more than once per quote adds up)."""
+        with self._lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(STAGE_BUCKETS)}
+            s['count'] += 1
+            s['sum'] += seconds
+            s['max'] = max(s['max'], seconds)
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if seconds <= bound:
+                    s['buckets'][i] += 1
+                    break
+            # Under the lock too; concurrent stages of one quote share the dict
+            if timings is not None:
+                timings[stage] = round(timings.get(stage, 0.0) + seconds, 6)
+
+    @contextmanager
+    def stage(self, stage, timings=None):
+        """Time the block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, timings)
+
+    def timed(self, stage):
+        """Decorator version of stage()"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """Returns:
+            snapshot(dict): 'counters' list of {name, labels, value},
+                'stages' stage -> count, sum, mean, max (seconds)"""
+        with self._lock:
+            return {
+                'timestamp': time.time(),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())],
+                'stages': {
+                    stage: {
+                        'count': s['count'],
+                        'sum': round(s['sum'], 6),
+                        'mean': round(s['sum'] / s['count'], 6) if s['count'] else 0.0,
+                        'max': round(s['max'], 6),
+                    }
+                    for stage, s in sorted(self.stages.items())},
+            }
+
+    def write_jsonl(self, path):
+        """Append one snapshot line"""
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
+
+    def to_prometheus(self):
+        """Prometheus text exposition format.
+
+        Returns:
+            text(str)
+        """
+        lines = []
+        with self._lock:
+            names_seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = '%s_%s_total' % (self.prefix, name)
+                if metric not in names_seen:
+                    lines.append('# TYPE %s counter' % metric)
+                    names_seen.add(metric)
+                lines.append('%s%s %d' % (metric, _labels(labels), value))
+            metric = '%s_stage_seconds' % self.prefix
+            if self.stages:
+                lines.append('# TYPE %s histogram' % metric)
+            for stage, s in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, n in zip(STAGE_BUCKETS, s['buckets']):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %d' % (metric, _labels((('stage', stage), ('le', le))), cumulative))
+                lines.append('%s_sum%s %.6f' % (metric, _labels((('stage', stage),)), s['sum']))
+                lines.append('%s_count%s %d' % (metric, _labels((('stage', stage),)), s['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """For node_exporter's textfile collector; written whole, then renamed into place"""
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(path + '.tmp', path)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+# Default instance the quote pipeline reports to
+METRICS = Metrics()
@@ -0,0 +1,254 @@
+# Copyright 2019 Eric Norman
+# Long running local quote service: quoting_engine.py behind HTTP (TCP or Unix socket),
+# so the storefront does not pay for imports, API keys, cold caches and new
+# connections on every checkout.
+#
+#     python quote_service.py --from-address warehouse.json --port 8765
+#     python quote_service.py --from-address warehouse.json --unix /tmp/quote.sock
+#
+#     POST /quote    {"to_address": {...}, "parcel": {...}, "deadline": 0.8}
+#     POST /quotes   {"orders": [{"to_address": {...}, "parcel": {...}}, ...]}
+#     GET  /health   cache / scheduler / connection pool stats
+#     GET  /metrics  Prometheus text
+#
+# Each order comes back as a quoting_engine.iter_accounting record.
+
+
+import argparse, json, os, socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import quoting_engine
+import provider_transport
+from provider_scheduler import PROVIDER_SCHEDULER
+from quote_cache import QuoteCache, AddressCache
+from quote_metrics import METRICS
+from quote_history import QuoteHistory
+from rate_table import RateTable
+
+
+# Largest request body accepted, bytes
+MAX_BODY = 4 * 1024 * 1024
+# Orders quoted at the same time within one /quotes request
+BATCH_WORKERS = 8
+
+
+class QuoteService:
+    """The warm state shared by every request.
+
+    Args:
+        from_address_dict(dict): default from-address, verified once at start
+        quote_cache(QuoteCache): optional
+        address_cache(AddressCache): optional
+        rate_table(RateTable): optional
+        quote_history(QuoteHistory): optional
+        quote_kwargs(dict): defaults for pull_and_calculate_customer_facing_quote
+            (concurrent, deadline, cache_late_results, ...); a request can override deadline
+    """
+
+    def __init__(self, from_address_dict=None, quote_cache=None, address_cache=None, rate_table=None,
+                 quote_kwargs=None, quote_history=None):
+        self.from_address_dict = from_address_dict
+        self.quote_cache = quote_cache
+        self.address_cache = address_cache
+        self.rate_table = rate_table
+        self.quote_history = quote_history
+        self.quote_kwargs = dict(quote_kwargs or {})
+
+    def warm_up(self):
+        """Verify the from-address now (into the address cache), not on the first checkout"""
+        if self.from_address_dict is not None and self.address_cache is not None:
+            quoting_engine._ep_verify_address(self.from_address_dict, self.address_cache)
+
+    def _request(self, order):
+        """Request body (one order) -> quoting_engine quote request"""
+        try:
+            to_address_dict = dict(order['to_address'])
+            parcel_dict_oz = order['parcel']
+        except (KeyError, TypeError):
+            raise ValueError('each order needs "to_address" and "parcel"')
+        from_address_dict = order.get('from_address') or self.from_address_dict
+        if from_address_dict is None:
+            raise ValueError('no "from_address" and the service has no default')
+        to_address_dict.setdefault('phone', '')
+        to_address_dict.setdefault('street2', '')
+        to_address_dict.setdefault('customer_order_id', order.get('customer_order_id'))
+        return {
+            'customer_order_id': to_address_dict['customer_order_id'],
+            'from_address_dict': from_address_dict,
+            'to_address_dict': to_address_dict,
+            'parcel_dict_oz': parcel_dict_oz,
+        }
+
+    def _quote_kwargs(self, body):
+        quote_kwargs = dict(self.quote_kwargs, quote_cache=self.quote_cache,
+                            address_cache=self.address_cache, rate_table=self.rate_table,
+                            quote_history=self.quote_history)
+        if 'deadline' in body:
+            quote_kwargs['deadline'] = body['deadline']
+        return quote_kwargs
+
+    def quote(self, body):
+        """One order.
+
+        Returns:
+            record(dict): see quoting_engine.iter_accounting
+        """
+        request = self._request(body)
+        quote_kwargs = self._quote_kwargs(body)
+        try:
+            r = quoting_engine._quote_request(request, quote_kwargs)
+        except Exception as e:
+            r = e
+        return next(quoting_engine.iter_accounting([(request, r)]))
+
+    def quote_batch(self, body):
+        """Many orders, quoted BATCH_WORKERS at a time.
+
+        Returns:
+            records(list of dict): in request order
+        """
+        orders = body.get('orders')
+        if not isinstance(orders, list):
+            raise ValueError('"orders" must be a list')
+        requests = [self._request(order) for order in orders]
+        for i, request in enumerate(requests):
+            request['index'] = i
+        records = [None] * len(requests)
+        quotes = quoting_engine.iter_quotes(requests, BATCH_WORKERS, **self._quote_kwargs(body))
+        for request, r in quotes:
+            records[request['index']] = next(quoting_engine.iter_accounting([(request, r)]))
+        return records
+
+    def health(self):
+        return {
+            'ok': True,
+            'pid': os.getpid(),
+            'quote_cache': self.quote_cache.stats() if self.quote_cache is not None else None,
+            'address_cache': self.address_cache.stats() if self.address_cache is not None else None,
+            'provider_rates': PROVIDER_SCHEDULER.stats(),
+            'connection_pools': provider_transport.pool_stats(),
+            'quote_history': self.quote_history.stats() if self.quote_history is not None else None,
+        }
+
+
+class QuoteRequestHandler(BaseHTTPRequestHandler):
+    """JSON in, JSON out; the QuoteService is server.quote_service"""
+
+    protocol_version = 'HTTP/1.1'   # keep-alive for the storefront too
+
+    def _send(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body, default=str)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            raise ValueError('request body over %d bytes' % MAX_BODY)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not isinstance(body, dict):
+            raise ValueError('request body must be a json object')
+        return body
+
+    def do_GET(self):
+        service = self.server.quote_service
+        if self.path == '/health':
+            self._send(200, service.health())
+        elif self.path == '/metrics':
+            self._send(200, METRICS.to_prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self._send(404, {'error': 'not found: %s' % self.path})
+
+    def do_POST(self):
+        service = self.server.quote_service
+        routes = {'/quote': service.quote, '/quotes': service.quote_batch}
+        if self.path not in routes:
+            self._send(404, {'error': 'not found: %s' % self.path})
+            return
+        try:
+            body = self._body()
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+        try:
+            self._send(200, routes[self.path](body))
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': '%s: %s' % (type(e).__name__, e)})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(quote_service, host='127.0.0.1', port=8765, unix_socket=None):
+    """HTTP server for quote_service on host:port, or on unix_socket if given"""
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, QuoteRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), QuoteRequestHandler)
+    server.quote_service = quote_service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local quote service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--from-address', help='json file with the default from_address_dict')
+    parser.add_argument('--quote-cache', help='sqlite file for the quote cache, default memory only')
+    parser.add_argument('--address-cache', default='address_cache.sqlite3')
+    parser.add_argument('--rate-table', help='.npz file, loaded at start and saved at exit')
+    parser.add_argument('--quote-history', help='directory to append every quoted rate to')
+    parser.add_argument('--deadline', type=float, help='default latency budget per quote, seconds')
+    parser.add_argument('--metrics', help='write Prometheus text here at exit')
+    args = parser.parse_args(argv)
+
+    from_address_dict = None
+    if args.from_address:
+        with open(args.from_address) as f:
+            from_address_dict = json.load(f)
+    rate_table = None
+    if args.rate_table:
+        rate_table = RateTable.load(args.rate_table) if os.path.exists(args.rate_table) else RateTable()
+    quote_kwargs = {'concurrent': True, 'cache_late_results': True}
+    if args.deadline is not None:
+        quote_kwargs['deadline'] = args.deadline
+    quote_service = QuoteService(
+        from_address_dict, QuoteCache(path=args.quote_cache), AddressCache(args.address_cache),
+        rate_table, quote_kwargs, QuoteHistory(args.quote_history) if args.quote_history else None)
+    quote_service.warm_up()
+
+    server = make_server(quote_service, args.host, args.port, args.unix)
+    print('quote service listening on %s' % (args.unix or '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix and os.path.exists(args.unix):
+            os.unlink(args.unix)
+        if rate_table is not None:
+            rate_table.save(args.rate_table)
+        if quote_service.quote_history is not None:
+            quote_service.quote_history.flush()
+        if args.metrics:
+            METRICS.write_prometheus(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
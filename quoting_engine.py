@@ -9,7 +9,8 @@
 # it was one of the first accumulators I had written, before I knew the concept.
 
 
-import sys, os, pprint, json, csv
+import sys, os, pprint, json, csv, time, threading, heapq, random, functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from pprint import pprint
 import easypost
@@ -23,22 +24,118 @@ from pack_cli.shipstation_functions import \
     get_quotes_for_carrier, \
     ss_generate_address_object_from_dict, \
     ss_get_fedex_shipping_label
+import pack_cli.shipstation_functions as shipstation_functions
+import provider_transport
+from accounting_constants import PLATFORM_FEE_PERCENT, SHIPPING_ACCOUNT_HOLDER_RATE
+from provider_scheduler import PROVIDER_SCHEDULER, DeadlineExceeded
+from quote_cache import quote_cache_key, address_cache_key, SingleFlight
+from quote_metrics import METRICS
 
 # easypost.api_key = easypost_test_api_key
 easypost.api_key = easypost_production_api_key
 CSV_PATH = 'csv/orders_export.csv'
 
+# FLAT RATES
+FLAT_RATES = {
+    'FlatRateEnvelope': 
+        {'length': 12.5,
+        'width': 9.5,
+        'height': 0.1,
+        'units': 'inches'},
+    'FlatRateLegalEnvelope': 
+        {'length': 15,
+        'width': 9.5,
+        'height': 0.1,
+        'units': 'inches'},
+}
+
+# Parcel consolidation (see consolidate_parcels); item sizes and the boxes we stock
+# come from the caller, there are no defaults
+# Heaviest parcel items are consolidated into, oz (USPS limit is 70 lb)
+MAX_PARCEL_WEIGHT_OZ = 70 * 16
+
+# Concurrent quoting; seconds each provider gets before we quote without it
+PROVIDER_TIMEOUTS = {
+    'easypost': 30,
+    'shipstation': 30,
+}
+PROVIDER_MAX_WORKERS = 16
+# Keep-alive connections per provider host, shared by every quote and thread;
+# room for the provider threads plus batch workers calling in sequential mode
+PROVIDER_POOL_SIZE = 2 * PROVIDER_MAX_WORKERS
+provider_transport.install(easypost, shipstation_functions, pool_size=PROVIDER_POOL_SIZE)
+
+# Identical requests in flight at the same time share one provider call. Provider calls
+# run under the deadline of the caller that made them; a waiting caller with more time
+# left makes its own call when that one ran out
+_QUOTE_FLIGHTS = SingleFlight()
+_ADDRESS_FLIGHTS = SingleFlight(retry_errors=(DeadlineExceeded,))
+_SS_QUOTE_FLIGHTS = SingleFlight(retry_errors=(DeadlineExceeded,))
+
+# Customs, international only; one EasyPost CustomsInfo per profile is reused across quotes
+CUSTOMS_PROFILE = {
+    'description': 'E-fabric',
+    'hs_tariff_number': '3926.20',
+    'value': 1,
+    'weight': 16,
+}
+_CUSTOMS_INFO_MEMO = {}
+_CUSTOMS_INFO_LOCK = threading.Lock()
+
+# Rate selection; (carrier, service code), use all lower case
+EXCLUDED_SERVICES = {
+    ('usps', 'parcelselect'),
+    ('usps', 'first'),
+    ('fedex', 'fedex_smartpost_parcel_select'),
+}
+RANKED_RATES_K = 3
+# What a day sooner is worth to the customer, for the 'best_value' ranking
+BEST_VALUE_DOLLARS_PER_DAY = 1.00
+# Quotes of a lane before the rate table is trusted to skip ShipStation
+RATE_TABLE_MIN_OBSERVATIONS = 5
+# Share of quotes that call ShipStation even when the rate table says it can not win
+RATE_TABLE_PROBE_RATE = 0.05
+
+# ShipStation account quotes and labels are under
+SHIPSTATION_CUSTOMER_NAME = 'Product Jump'
+# USPS: SIGNATURE: does pass to Shipment, does not add cost
+# USPS: signature, ADULT_SIGNATURE does not register
+# USPS: INDIRECT_SIGNATURE is error
+SS_DELIVERY_CONFIRMATION = 'SIGNATURE'
+# EasyPost postage_label attribute per label format
+EP_LABEL_URL_FIELDS = {'PNG': 'label_url', 'PDF': 'label_pdf_url', 'ZPL': 'label_zpl_url'}
+_PROVIDER_EXECUTORS = {}
+_PROVIDER_EXECUTOR_LOCK = threading.Lock()
+
+
+def _order_row_to_address_dict(row):
+    """Shopify export row -> to_address_dict"""
+    to_address_dict = {}
+    to_address_dict['customer_order_id'] = row['Name']
+    to_address_dict['sales_platform__order_id'] = row['Id']
+    to_address_dict['name'] = row['Shipping Name']
+    to_address_dict['street1'] = row['Shipping Street']
+    to_address_dict['street2'] = row['Shipping Address2']
+    to_address_dict['city'] = row['Shipping City']
+    to_address_dict['state'] = row['Shipping Province']
+    to_address_dict['postal_code'] = row['Shipping Zip']
+    to_address_dict['country'] = row['Shipping Country']
+    to_address_dict['phone'] = row['Shipping Phone']
+    return to_address_dict
+
 
 def read_order_csv_and_return_to_address_and_items(CSV_PATH, ORDER_TO_PULL=None):
     """
     Very limited read of order data for quoting and shipping label creation.
 
     Limitation examples: 
-        cannot handle multi-item (row) order
+        returns no line items; for multi-item (row) orders use iter_orders
         orders_to_filter must be done manually
         does not pull in 'Shipping Company'; because not enough fields in EasyPost
         does not assign internal unique ID
 
+    Scans the whole file; for more than one order use iter_orders.
+
     Args:
         CSV_PATH(str): repo relative path to file to read
         ORDER_TO_PULL(str): which order to operate on
@@ -50,21 +147,483 @@ def read_order_csv_and_return_to_address_and_items(CSV_PATH, ORDER_TO_PULL=None)
     with open(CSV_PATH) as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
+            # First row of the order has the shipping address; the others are blank there
             if row['Name'].casefold() == ORDER_TO_PULL.casefold():
-                to_address_dict['customer_order_id'] = row['Name']
-                to_address_dict['sales_platform__order_id'] = row['Id']
-                to_address_dict['name'] = row['Shipping Name']
-                to_address_dict['street1'] = row['Shipping Street']
-                to_address_dict['street2'] = row['Shipping Address2']
-                to_address_dict['city'] = row['Shipping City']
-                to_address_dict['state'] = row['Shipping Province']
-                to_address_dict['postal_code'] = row['Shipping Zip']
-                to_address_dict['country'] = row['Shipping Country']
-                to_address_dict['phone'] = row['Shipping Phone']
+                to_address_dict = _order_row_to_address_dict(row)
+                break
     return to_address_dict
 
 
-def pull_and_calculate_customer_facing_quote(from_address_dict, to_address_dict, parcel_dict_oz, excluded=[]):
+def _provider_call(provider, call, function, *args, **kwargs):
+    """Every EasyPost / ShipStation request goes through here; counts calls and errors.
+    Rate limited per provider, 429s / transient errors retried with backoff (see provider_scheduler).
+
+    Args:
+        provider(str): 'easypost' or 'shipstation'
+        call(str): API call name for the counters, e.g. 'Shipment.create'
+        function: makes the request
+    """
+    return PROVIDER_SCHEDULER.call(provider, call, _counted_attempt(provider, call, function, args, kwargs))
+
+
+def _provider_purchase(provider, call, function, *args, **kwargs):
+    """_provider_call for requests that spend money: never sent again after an error
+    that may have reached the provider (only a 429, which it refused, is retried)"""
+    return PROVIDER_SCHEDULER.call(
+        provider, call, _counted_attempt(provider, call, function, args, kwargs), retry=False)
+
+
+def _counted_attempt(provider, call, function, args, kwargs):
+    def attempt():
+        METRICS.count('api_calls', provider=provider, call=call)
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            METRICS.count('api_errors', provider=provider, call=call)
+            raise
+    return attempt
+
+
+def _timed_call(stage, timings, function, *args):
+    """function(*args) timed as a pipeline stage, into METRICS and the per-quote timings"""
+    with METRICS.stage(stage, timings):
+        return function(*args)
+
+
+def _ep_create_parcel(parcel_dict_oz):
+    """Create the EasyPost parcel, predefined (flat rate) package if given.
+
+    Args:
+        parcel_dict_oz(dict): dimensions in inches, weight with unit -oz
+
+    Returns:
+        ep_parcel_object(EP Object)
+    """
+    try:
+        predefined_package = parcel_dict_oz['predefined_package']
+        ep_parcel_object = _provider_call(
+            'easypost', 'Parcel.create', easypost.Parcel.create,
+            predefined_package = predefined_package,
+            weight = parcel_dict_oz['weight_oz'],
+        )
+    except KeyError:
+        ep_parcel_object = _provider_call(
+            'easypost', 'Parcel.create', ep_generate_parcel_object, parcel_dict_oz)
+    #TODO: allow flatrateenvelopes
+    return ep_parcel_object
+
+
+def _ep_verify_address(address_dict, address_cache=None):
+    """Verify an address with EasyPost; one API round trip unless cached, or the same
+    address is already being verified (then that result is shared).
+
+    Args:
+        address_dict(dict): address (not as object)
+        address_cache(AddressCache): optional, input address -> verified address
+
+    Returns:
+        verified_address_dict(dict): includes EasyPost 'id' and 'residential' flag
+    """
+    if address_cache is not None:
+        verified_address_dict = address_cache.get(address_dict)
+        if verified_address_dict is not None:
+            METRICS.count('cache_hits', cache='address')
+            return verified_address_dict
+        METRICS.count('cache_misses', cache='address')
+    verified_address_dict, shared = _ADDRESS_FLIGHTS.do(
+        address_cache_key(address_dict), _ep_create_verified_address, address_dict)
+    if shared:
+        METRICS.count('coalesced', provider='easypost', call='Address.create')
+    elif address_cache is not None:
+        address_cache.put(address_dict, verified_address_dict)
+    return dict(verified_address_dict)
+
+
+def _ep_create_verified_address(address_dict):
+    ep_address_object = _provider_call(
+        'easypost', 'Address.create', ep_generate_address_object,
+        address_dict['name'],
+        address_dict['street1'],
+        address_dict['country'],
+        address_dict['postal_code'],
+        address_dict['street2'],
+        address_dict['city'],
+        address_dict['state'],
+        address_dict['phone'],
+        address_dict.get('company', ''),
+        )
+    verified_address_dict = ep_convert_address_object_to_dict(ep_address_object)
+    verified_address_dict['id'] = ep_address_object.id
+    verified_address_dict['residential'] = ep_address_object.residential
+    return verified_address_dict
+
+
+def _ep_get_customs_info(customs_profile=CUSTOMS_PROFILE):
+    """EasyPost customs objects for a customs profile; two API round trips the first
+    time, then the same object is reused for every quote with that profile.
+
+    Args:
+        customs_profile(dict): description, hs_tariff_number, value, weight (oz)
+
+    Returns:
+        customs_info_object(EP Object)
+    """
+    memo_key = tuple(sorted(customs_profile.items()))
+    customs_info_object = _CUSTOMS_INFO_MEMO.get(memo_key)
+    if customs_info_object is not None:
+        return customs_info_object
+    with _CUSTOMS_INFO_LOCK:
+        # Another quote may have created it while we waited
+        customs_info_object = _CUSTOMS_INFO_MEMO.get(memo_key)
+        if customs_info_object is not None:
+            return customs_info_object
+        # NOTE: DHL requires value in CustomsItem
+        customs_item_object = _provider_call(
+            'easypost', 'CustomsItem.create', easypost.CustomsItem.create,
+            description=customs_profile['description'],
+            quantity=1,
+            value=customs_profile['value'],
+            weight=customs_profile['weight'],
+            hs_tariff_number=customs_profile['hs_tariff_number'],
+            origin_country='US'
+        )
+        customs_info_object = _provider_call(
+            'easypost', 'CustomsInfo.create', easypost.CustomsInfo.create,
+            eel_pfc='NOEEI 30.37(a)',
+            contents_type='sample',
+            customs_certify=True,
+            customs_signer='NAME',
+            restriction_type='none',
+            customs_items=[customs_item_object]
+        )
+        _CUSTOMS_INFO_MEMO[memo_key] = customs_info_object
+    return customs_info_object
+
+
+def _is_domestic(from_address_dict, to_address_dict):
+    """US -> US, by the verified country codes"""
+    return to_address_dict['country'] == 'US' and from_address_dict['country'] == 'US'
+
+
+def _ep_create_shipment(from_address_dict, to_address_dict, ep_parcel_object, customs_info_object):
+    """Create the EasyPost shipment, which rates every carrier on the account.
+
+    Args:
+        from/to_address_dict(dict): verified, EasyPost address is referenced by 'id'
+        customs_info_object(EP Object): None for domestic shipments
+
+    Returns:
+        ep_shipment(EP Object): can be used to purchase ep_shipment
+    """
+    shipment_args = {
+        'from_address': {'id': from_address_dict['id']},
+        'to_address': {'id': to_address_dict['id']},
+        'parcel': ep_parcel_object,
+    }
+    if customs_info_object is not None:
+        shipment_args['customs_info'] = customs_info_object
+    ep_shipment = _provider_call('easypost', 'Shipment.create', easypost.Shipment.create, **shipment_args)
+    try:
+        if ep_shipment.messages != None and len(ep_shipment.messages) != 0:
+            if 'Unable to retrieve DHLExpress rates for US domestic'.casefold() in str(ep_shipment.messages).casefold():
+                pass
+            else:
+                print(ep_shipment.messages)
+    except KeyError:
+        print('No Messages in Shipment')
+    return ep_shipment
+
+
+def _ss_dimensions(parcel_dict_oz):
+    """ShipStation dimensions of the parcel, flat rate box if predefined"""
+    try:
+        predefined_package = parcel_dict_oz['predefined_package']
+        dimensions = {
+            'length': FLAT_RATES[predefined_package]['length'],
+            'width': FLAT_RATES[predefined_package]['width'],
+            'height': FLAT_RATES[predefined_package]['height'],
+            'units': FLAT_RATES[predefined_package]['units']
+        }
+    except KeyError:
+        dimensions = {
+            'length': parcel_dict_oz['length'],
+            'width': parcel_dict_oz['width'],
+            'height': parcel_dict_oz['height'],
+            'units': 'inches'
+        }
+    return dimensions
+
+
+def _ss_get_quotes(from_address_dict, to_address_dict, parcel_dict_oz, customer_name):
+    """Quote FedEx from ShipStation, using the corrected address from EasyPost.
+
+    Args:
+        from/to_address_dict(dict): verified by EasyPost
+
+    Returns:
+        ss_quotes(list of dict): raw ShipStation quotes
+    """
+    to_address_ss_object = ss_generate_address_object_from_dict(to_address_dict)
+    dimensions = _ss_dimensions(parcel_dict_oz)
+    weight_grams = convert_ounces_to_grams(parcel_dict_oz['weight_oz'])
+    carrierCode = 'fedex'
+    delivery_confirmation = SS_DELIVERY_CONFIRMATION
+    print("Hard coded: delivery_confirmation='SIGNATURE'")  
+    from_address_ss_object = ss_generate_address_object_from_dict(from_address_dict)
+    serviceCode = None
+    # Same request already out (flash sale, one product to one area): wait for that one
+    flight_key = json.dumps([
+        customer_name, to_address_dict, weight_grams, carrierCode,
+        dimensions, delivery_confirmation, from_address_dict, serviceCode], sort_keys=True, default=str)
+    ss_quotes, shared = _SS_QUOTE_FLIGHTS.do(
+        flight_key, _provider_call,
+        'shipstation', 'get_quotes_for_carrier', get_quotes_for_carrier,
+        customer_name, to_address_ss_object, weight_grams, carrierCode,
+        dimensions, delivery_confirmation, from_address_ss_object, serviceCode)
+    if shared:
+        METRICS.count('coalesced', provider='shipstation', call='get_quotes_for_carrier')
+    return list(ss_quotes)
+
+
+class Rate:
+    """One rate from any provider; EasyPost and ShipStation rates are both mapped into this.
+
+    Args:
+        provider(str): 'easypost' or 'shipstation'
+        carrier(str): as the provider spells it, e.g. 'USPS', 'fedex'
+        service(str): display name, e.g. 'Priority', 'FedEx Ground'
+        service_code(str): what the provider wants to buy it, e.g. 'Priority', 'fedex_ground'
+        rate(float): total cost
+        list_rate(float): EasyPost only, None otherwise
+        est_delivery_days(int): None if unknown (always for SS)
+        source(str): quote platform / account, e.g. 'easypost/ca_...'
+        quote_id(str): EasyPost rate id to buy, None for SS
+        corrected(bool): rate was healed to list_rate (see select_rates)
+    """
+    __slots__ = ('provider', 'carrier', 'service', 'service_code', 'rate', 'list_rate',
+                 'est_delivery_days', 'source', 'quote_id', 'corrected')
+
+    def __init__(self, provider, carrier, service, service_code, rate, list_rate=None,
+                 est_delivery_days=None, source=None, quote_id=None, corrected=False):
+        self.provider = provider
+        self.carrier = carrier
+        self.service = service
+        self.service_code = service_code
+        self.rate = rate
+        self.list_rate = list_rate
+        self.est_delivery_days = est_delivery_days
+        self.source = source
+        self.quote_id = quote_id
+        self.corrected = corrected
+
+    def __repr__(self):
+        return 'Rate(%s %s %s $%.2f, %s days)' % (
+            self.provider, self.carrier, self.service, self.rate, self.est_delivery_days)
+
+    def to_dict(self):
+        """Same keys as best_quote"""
+        return {
+            'rate': self.rate,
+            'service': self.service,
+            'service_code': self.service_code,
+            'carrier': self.carrier,
+            'source': self.source,
+            'quote_id': self.quote_id,
+            'est_delivery_days': self.est_delivery_days,
+        }
+
+
+def rates_from_easypost(ep_rates):
+    """Returns:
+        rates(list of Rate)"""
+    return [
+        Rate('easypost', rate.carrier, rate.service, rate.service, float(rate.rate),
+             float(rate.list_rate) if rate.list_rate else None, rate.est_delivery_days,
+             'easypost/' + rate.carrier_account_id.lower(), rate.id)
+        for rate in ep_rates]
+
+
+def rates_from_shipstation(ss_quotes, customer_name):
+    """Returns:
+        rates(list of Rate)"""
+    return [
+        Rate('shipstation', q['carrierCode'], q['serviceName'], q['serviceCode'],
+             q['shipmentCost'] + q['otherCost'], source='shipstation/' + customer_name.lower())
+        for q in ss_quotes]
+
+
+def _push_top_k(heap, k, key, rate):
+    # heapq is a min-heap; keep the k smallest keys by storing them negated,
+    # so heap[0] is the worst one kept
+    entry = (tuple(-x for x in key), rate)
+    if len(heap) < k:
+        heapq.heappush(heap, entry)
+    elif entry[0] > heap[0][0]:
+        heapq.heapreplace(heap, entry)
+
+
+def select_rates(rates, excluded_services=EXCLUDED_SERVICES, k=RANKED_RATES_K):
+    """Single pass over every provider's rates: exclusions, the USPS list rate
+    correction, the comparison rate and the top k rankings.
+
+    Ties go to the rate seen first, so EasyPost beats ShipStation at the same price.
+    USPS rates corrected to list rate are kept out of the rankings (they are still
+    used as the comparison), same as before this was one loop.
+
+    Args:
+        rates(list of Rate): EasyPost first, then ShipStation
+        excluded_services(set of tuple): (carrier, service_code), lower case
+        k(int): how many of each ranking to return
+
+    Returns:
+        selection(dict):
+            'cheapest'(list of Rate): by rate
+            'fastest'(list of Rate): by est_delivery_days, then rate; unknown days left out
+            'best_value'(list of Rate): by rate + BEST_VALUE_DOLLARS_PER_DAY * est_delivery_days
+            'comparison'(Rate): EasyPost USPS Priority, None if not offered
+    """
+    cheapest = []
+    fastest = []
+    best_value = []
+    comparison = None
+    for seq, rate in enumerate(rates):
+        carrier = rate.carrier.casefold()
+        if (carrier, rate.service_code.casefold()) in excluded_services:
+            continue
+        if carrier == 'usps' and rate.list_rate is not None and rate.rate != rate.list_rate:
+            # 2019-05-31 Ran into USPS quoting bug where priority mail was quoted way too 
+            # low by multiple providers. The "list_rate" was correct, though, and equal
+            # to what "rate" should have been. So testing for that here and healing, 
+            # but giving a warning in the service string so you know it happened
+            print("USPS quote appears to be wrong. Rate is %.2f, but list rate is %.2f. They should be equal."%(rate.rate,rate.list_rate))
+            rate = Rate(rate.provider, rate.carrier, rate.service + ' *** LIST RATE (CPP, corrected) ***',
+                        rate.service_code, float('%.2f'%(max(rate.rate,rate.list_rate))), rate.list_rate,
+                        rate.est_delivery_days, rate.source, rate.quote_id, corrected=True)
+        # Comparison rate; hard-coded to USPS Priority and EasyPost
+        if rate.provider == 'easypost' and carrier == 'usps' and 'priority' in rate.service.casefold():
+            comparison = rate
+        if rate.corrected:
+            continue
+        _push_top_k(cheapest, k, (rate.rate, seq), rate)
+        if rate.est_delivery_days is not None:
+            _push_top_k(fastest, k, (rate.est_delivery_days, rate.rate, seq), rate)
+            _push_top_k(best_value, k, (rate.rate + BEST_VALUE_DOLLARS_PER_DAY * rate.est_delivery_days, seq), rate)
+    return {
+        'cheapest': [entry[1] for entry in sorted(cheapest, reverse=True)],
+        'fastest': [entry[1] for entry in sorted(fastest, reverse=True)],
+        'best_value': [entry[1] for entry in sorted(best_value, reverse=True)],
+        'comparison': comparison,
+    }
+
+
+def _ss_can_win(rate_table, ep_rates, from_address_dict, to_address_dict, parcel_dict_oz):
+    """False if the lane's ShipStation history can not beat the best EasyPost rate.
+    Ties go to EasyPost, so a floor equal to the best does not win either.
+    A few quotes call anyway, so a floor that has gone stale is pulled back up
+    (see rate_table.FLOOR_RISE)."""
+    if rate_table is None or random.random() < RATE_TABLE_PROBE_RATE:
+        return True
+    ss_floor = rate_table.lane_floor(
+        from_address_dict, to_address_dict, parcel_dict_oz, 'shipstation',
+        min_observations=RATE_TABLE_MIN_OBSERVATIONS)
+    cheapest = select_rates(ep_rates, k=1)['cheapest']
+    if cheapest and ss_floor != float('inf') and cheapest[0].rate <= ss_floor:
+        print('Skipping shipstation: easypost best %.2f <= shipstation floor %.2f for this lane' % (
+            cheapest[0].rate, ss_floor))
+        return False
+    return True
+
+
+def _ss_deferrable(rate_table, from_address_dict, to_address_dict, parcel_dict_oz):
+    """True if history says ShipStation likely can not win the lane: its floor is at or
+    above EasyPost's best mean price there. Concurrent mode then waits for EasyPost before
+    deciding; otherwise ShipStation goes out alongside, since it is probably needed."""
+    if rate_table is None:
+        return False
+    ss_floor = rate_table.lane_floor(
+        from_address_dict, to_address_dict, parcel_dict_oz, 'shipstation',
+        min_observations=RATE_TABLE_MIN_OBSERVATIONS)
+    if ss_floor == float('inf'):
+        return False
+    ep_estimates = [price for (provider, carrier, service_code), price in rate_table.estimate(
+        from_address_dict, to_address_dict, parcel_dict_oz).items() if provider == 'easypost']
+    return bool(ep_estimates) and min(ep_estimates) <= ss_floor
+
+
+def _get_provider_executor(provider):
+    """Shared worker threads for one provider's calls; created on first concurrent quote.
+    Not a `with` block per quote, so a provider timeout does not wait on the late call.
+    One pool per provider, so calls waiting on one provider's rate limit never hold
+    up the other's."""
+    with _PROVIDER_EXECUTOR_LOCK:
+        executor = _PROVIDER_EXECUTORS.get(provider)
+        if executor is None:
+            executor = _PROVIDER_EXECUTORS[provider] = ThreadPoolExecutor(
+                max_workers=PROVIDER_MAX_WORKERS, thread_name_prefix=provider)
+    return executor
+
+
+def _submit_provider_call(provider, deadline, stage, timings, function, *args):
+    """_timed_call on the provider's executor. Its provider calls give up (DeadlineExceeded)
+    rather than wait for the rate limiter past deadline, when the caller has stopped waiting.
+
+    Returns:
+        future(Future)
+    """
+    return _get_provider_executor(provider).submit(_deadline_call, deadline, stage, timings, function, *args)
+
+
+def _deadline_call(deadline, stage, timings, function, *args):
+    with PROVIDER_SCHEDULER.deadline(deadline):
+        return _timed_call(stage, timings, function, *args)
+
+
+def _remaining(deadline):
+    return max(0, deadline - time.monotonic())
+
+
+class SkippedQuote(tuple):
+    """Returned instead of a quote when there is nothing to offer the customer.
+    Still the ({},{}) callers have always checked for, plus why.
+
+    Args:
+        reason(str): e.g. 'not_cheaper', 'easypost_timeout'
+    """
+
+    def __new__(cls, reason):
+        skipped = tuple.__new__(cls, ({}, {}))
+        skipped.reason = reason
+        return skipped
+
+
+def _quote_from_cache(cached, from_address_dict, to_address_dict, parcel_dict_oz, address_cache=None):
+    """Rebuild the return tuple of pull_and_calculate_customer_facing_quote from a cache entry.
+    There is no ep_shipment and no quote_id; the 'from'/'to' headers are the verified
+    addresses if address_cache has them, otherwise the addresses as given."""
+    if cached['skipped']:
+        return SkippedQuote(cached.get('skip_reason', 'cached'))
+    best_quote = dict(cached['best_quote'])
+    best_quote['quote_id'] = None
+    best_quote.setdefault('timed_out', [])
+    best_quote['alternatives'] = {
+        ranking: [dict(r, quote_id=None) for r in alternatives]
+        for ranking, alternatives in cached['best_quote']['alternatives'].items()}
+    if address_cache is not None:
+        best_quote['from'] = address_cache.get(from_address_dict) or from_address_dict
+        best_quote['to'] = address_cache.get(to_address_dict) or to_address_dict
+    else:
+        best_quote['from'] = from_address_dict
+        best_quote['to'] = to_address_dict
+    best_quote['parcel'] = parcel_dict_oz
+    ss_quotes_to_return = {'ss_rates': [dict(r) for r in cached['ss_quotes']['ss_rates']]}
+    return (best_quote, dict(cached['comparison_quote']), None, ss_quotes_to_return)
+
+
+def pull_and_calculate_customer_facing_quote(from_address_dict, to_address_dict, parcel_dict_oz, excluded=[],
+                                             concurrent=False, timeouts=None,
+                                             quote_cache=None, need_shipment=False, address_cache=None,
+                                             rate_table=None, deadline=None, cache_late_results=False,
+                                             quote_history=None):
     """
     Assumes
         item is enflux large item
@@ -76,9 +635,45 @@ def pull_and_calculate_customer_facing_quote(from_address_dict, to_address_dict,
             includes description(str): to print for customer
         excluded(list of str): service or carrier
             example: if customer does not want FedEx, put "['fedex']"
+        concurrent(bool): send the EasyPost and ShipStation requests at the same time.
+            Parcel, both address verifications and customs go out together, then
+            Shipment.create and the ShipStation quote (which needs the verified addresses)
+            go out together. Latency is close to the slowest provider instead of the sum.
+        timeouts(dict): seconds per provider, e.g. {'easypost': 10, 'shipstation': 5};
+            concurrent only, missing keys default to PROVIDER_TIMEOUTS.
+            EasyPost timing out skips the quote (no comparison rate);
+            ShipStation timing out quotes from EasyPost alone with empty 'ss_rates'.
+        quote_cache(QuoteCache): serve repeat lanes / parcel profiles without calling providers.
+            A hit returns ep_shipment None and quote_id None; timeouts are never cached.
+        need_shipment(bool): bypass the cache (and coalescing), caller is going to buy the ep_shipment
+        address_cache(AddressCache): reuse earlier verifications (the warehouse from-address,
+            repeat customers) for both EasyPost and ShipStation
+        rate_table(RateTable): lane price history, updated with every quote. Once a lane has
+            history, ShipStation is only called if its recent floor can beat EasyPost's best;
+            in concurrent mode it waits for EasyPost only on lanes where EasyPost's mean price
+            is already at or below that floor, otherwise it goes out alongside.
+        deadline(float): latency budget in seconds for the whole quote, e.g. 0.8; implies concurrent.
+            When it runs out, quote from the providers that have answered: a provider that has
+            not is listed in best_quote['timed_out']. EasyPost has the comparison rate, so
+            without it the quote is skipped ('easypost_timeout').
+            A quote missing a provider is never cached.
+        cache_late_results(bool): with quote_cache, when a provider answers after the quote
+            was returned, cache the full quote (and update rate_table) for the next order on the lane
+        quote_history(QuoteHistory): every rate every provider returns goes in it, excluded
+            services included; a provider answering late is added to its quote. Cache hits
+            and coalesced orders add nothing, no provider was asked.
+
+    Concurrent calls for the same lane, parcel profile and exclusions share one quote
+    (and identical address verifications / ShipStation quotes share one request);
+    the orders that waited get it like a cache hit: ep_shipment None, quote_id None.
 
     Returns:
+        SkippedQuote (({},{}) with a .reason) if there is no quote, otherwise
         tuple[0] best_quote(dict): raw best quote, before platform fees
+            includes 'alternatives': top RANKED_RATES_K 'cheapest', 'fastest' and
+            'best_value' rates (see select_rates) as dicts
+            includes 'stage_timings': seconds per pipeline stage for this quote
+            includes 'timed_out': providers left out because they did not answer in time
         tuple[1] comparison_quote(dict): raw comparison
         tuple[2] ep_shipment(EP Object): can be used to purchase ep_shipment
         tuple[3] ss_quotes(dict): list of shipstation quote dicts under the "ss_rates" key. Example:
@@ -94,201 +689,241 @@ def pull_and_calculate_customer_facing_quote(from_address_dict, to_address_dict,
                 ]
             }
     """
-    # use all lower case
-    excluded = ['parcelselect', 'first', 'fedex_smartpost_parcel_select']
-    EXCLUDED_USPS = ['first']
-    # try a dict with key of carrier code, value of service code
-    excluded_dict = {
-        'usps': ['parcelselect', 'first'],
-        'fedex': ['fedex_smartpost_parcel_select']
-        }
+    quote_start = time.perf_counter()
+    timings = {}
+    if deadline is not None:
+        concurrent = True
+        quote_deadline = time.monotonic() + deadline
+    else:
+        quote_deadline = None
+    if need_shipment:
+        return _pull_quote(from_address_dict, to_address_dict, parcel_dict_oz, concurrent, timeouts,
+                           address_cache, rate_table, None, None, timings, quote_start,
+                           quote_deadline, False, quote_history)[0]
+    cache_key = quote_cache_key(from_address_dict, to_address_dict, parcel_dict_oz, excluded)
+    if quote_cache is not None:
+        cached = quote_cache.get(cache_key)
+        if cached is not None:
+            METRICS.count('cache_hits', cache='quote')
+            r = _quote_from_cache(cached, from_address_dict, to_address_dict, parcel_dict_oz, address_cache)
+            METRICS.observe('quote_cache', time.perf_counter() - quote_start, timings)
+            if r[0]:
+                r[0]['stage_timings'] = timings
+            return r
+        METRICS.count('cache_misses', cache='quote')
+    # Same lane and parcel already being quoted: wait for it instead of calling the providers again;
+    # only with the same latency budget, a call without one may take longer than this caller has
+    (r, entry), shared = _QUOTE_FLIGHTS.do(
+        (cache_key, deadline), _pull_quote, from_address_dict, to_address_dict, parcel_dict_oz, concurrent,
+        timeouts, address_cache, rate_table, quote_cache, cache_key, timings, quote_start,
+        quote_deadline, cache_late_results, quote_history)
+    if not shared:
+        return r
+    METRICS.count('coalesced', call='quote')
+    if entry is None:
+        return r
+    # Rebuilt for this order the same way as a cache hit
+    r = _quote_from_cache(entry, from_address_dict, to_address_dict, parcel_dict_oz, address_cache)
+    METRICS.observe('quote_coalesced', time.perf_counter() - quote_start, timings)
+    if r[0]:
+        r[0]['stage_timings'] = timings
+    return r
 
-    # FLAT RATES
-    flat_rates = {
-        'FlatRateEnvelope': 
-            {'length': 12.5,
-            'width': 9.5,
-            'height': 0.1,
-            'units': 'inches'},
-        'FlatRateLegalEnvelope': 
-            {'length': 15,
-            'width': 9.5,
-            'height': 0.1,
-            'units': 'inches'},
-    }
 
+def _pull_quote(from_address_dict, to_address_dict, parcel_dict_oz, concurrent, timeouts,
+                address_cache, rate_table, quote_cache, cache_key, timings, quote_start,
+                quote_deadline=None, cache_late_results=False, quote_history=None):
+    """The provider calls of pull_and_calculate_customer_facing_quote.
+
+    Args:
+        quote_deadline(float): time.monotonic() by which to return, None for no budget
+
+    Returns:
+        tuple[0]: what pull_and_calculate_customer_facing_quote returns
+        tuple[1] entry(dict): the result as a quote cache entry, None if it must not be
+            reused (EasyPost timeouts, no rates)
+    """
+    # use all lower case; services are excluded by EXCLUDED_SERVICES
+    excluded = ['parcelselect', 'first', 'fedex_smartpost_parcel_select']
+    customer_name = SHIPSTATION_CUSTOMER_NAME
+    timed_out = []    # providers quoted without
+    history_quote = None    # quote_history id, once recorded
+    # ShipStation may answer after the quote (and its timings) went back to the caller;
+    # its stage goes in timings only if it answered in time
+    ss_timings = {}
 
     # EasyPost
     # Use EasyPost verified address + residential flag for all quoting / label purchase
-    try:
-        predefined_package = parcel_dict_oz['predefined_package']
-        ep_parcel_object = easypost.Parcel.create(
-            predefined_package = predefined_package,
-            weight = parcel_dict_oz['weight_oz'],
-        )
-    except KeyError:
-        ep_parcel_object = ep_generate_parcel_object(parcel_dict_oz)
-    #TODO: allow flatrateenvelopes
-    ep_from_address_object = ep_generate_address_object(
-        from_address_dict['name'],
-        from_address_dict['street1'],
-        from_address_dict['country'],
-        from_address_dict['postal_code'],
-        from_address_dict['street2'],
-        from_address_dict['city'], 
-        from_address_dict['state'],
-        from_address_dict['phone'],
-        from_address_dict['company'],
-        )
-    ep_to_address_object = ep_generate_address_object(
-        to_address_dict['name'],
-        to_address_dict['street1'], 
-        to_address_dict['country'],
-        to_address_dict['postal_code'],
-        to_address_dict['street2'],
-        to_address_dict['city'],
-        to_address_dict['state'],
-        to_address_dict['phone'],
-        to_address_dict['company'],
-        )
-    # NOTE: DHL requires value in CustomsItem
-    customs_item_object = easypost.CustomsItem.create(
-        description='E-fabric',
-        quantity=1,
-        value=1,
-        weight=16,
-        hs_tariff_number='3926.20',
-        origin_country='US'
-    )
-    customs_info_object = easypost.CustomsInfo.create(
-        eel_pfc='NOEEI 30.37(a)',
-        contents_type='sample',
-        customs_certify=True,
-        customs_signer='NAME',
-        restriction_type='none',
-        customs_items=[customs_item_object]
-    )
-    ep_shipment = easypost.Shipment.create(
-        from_address = ep_from_address_object,
-        to_address = ep_to_address_object,
-        parcel = ep_parcel_object,
-        customs_info = customs_info_object
-    )
-    try:
-        if ep_shipment.messages != None and len(ep_shipment.messages) != 0:
-            if 'Unable to retrieve DHLExpress rates for US domestic'.casefold() in str(ep_shipment.messages).casefold():
-                pass
-            else:
-                print(ep_shipment.messages)
-    except KeyError:
-        print('No Messages in Shipment')
+    if concurrent:
+        provider_timeouts = dict(PROVIDER_TIMEOUTS, **(timeouts or {}))
+        ep_deadline = min(time.monotonic() + provider_timeouts['easypost'], quote_deadline or float('inf'))
+        ep_parcel_future = _submit_provider_call(
+            'easypost', ep_deadline, 'parcel', timings, _ep_create_parcel, parcel_dict_oz)
+        ep_from_address_future = _submit_provider_call(
+            'easypost', ep_deadline, 'address_verification', timings,
+            _ep_verify_address, from_address_dict, address_cache)
+        ep_to_address_future = _submit_provider_call(
+            'easypost', ep_deadline, 'address_verification', timings,
+            _ep_verify_address, to_address_dict, address_cache)
+        try:
+            from_address_dict = ep_from_address_future.result(timeout=_remaining(ep_deadline))
+            to_address_dict = ep_to_address_future.result(timeout=_remaining(ep_deadline))
+        except (FutureTimeoutError, DeadlineExceeded):
+            print('Skipping: easypost address verification timed out')
+            METRICS.count('provider_timeouts', provider='easypost')
+            return SkippedQuote('address_verification_timeout'), None
+        # Customs only for international lanes; memoized, so no round trip after the first
+        if _is_domestic(from_address_dict, to_address_dict):
+            customs_info_future = None
+        else:
+            customs_info_future = _submit_provider_call(
+                'easypost', ep_deadline, 'customs', timings, _ep_get_customs_info)
+        # Same rule as below, decided early so the ShipStation call is not sent for nothing
+        if 'fedex' in excluded:
+            ss_quotes_future = None
+        elif _ss_deferrable(rate_table, from_address_dict, to_address_dict, parcel_dict_oz):
+            # EasyPost usually wins this lane; wait for it, ShipStation may not be needed
+            ss_quotes_future = None
+        else:
+            ss_deadline = min(time.monotonic() + provider_timeouts['shipstation'], quote_deadline or float('inf'))
+            ss_quotes_future = _submit_provider_call(
+                'shipstation', ss_deadline, 'shipstation_quote', ss_timings,
+                _ss_get_quotes, from_address_dict, to_address_dict, parcel_dict_oz, customer_name)
+        try:
+            ep_shipment_future = _submit_provider_call(
+                'easypost', ep_deadline, 'shipment', timings, _ep_create_shipment, from_address_dict, to_address_dict,
+                ep_parcel_future.result(timeout=_remaining(ep_deadline)),
+                customs_info_future.result(timeout=_remaining(ep_deadline)) if customs_info_future else None)
+            ep_shipment = ep_shipment_future.result(timeout=_remaining(ep_deadline))
+        except (FutureTimeoutError, DeadlineExceeded):
+            print('Skipping: easypost did not answer in time')
+            METRICS.count('provider_timeouts', provider='easypost')
+            return SkippedQuote('easypost_timeout'), None
+    else:
+        ss_quotes_future = None
+        ep_parcel_object = _timed_call('parcel', timings, _ep_create_parcel, parcel_dict_oz)
+        from_address_dict = _timed_call(
+            'address_verification', timings, _ep_verify_address, from_address_dict, address_cache)
+        to_address_dict = _timed_call(
+            'address_verification', timings, _ep_verify_address, to_address_dict, address_cache)
+        # Customs only for international lanes
+        if _is_domestic(from_address_dict, to_address_dict):
+            customs_info_object = None
+        else:
+            customs_info_object = _timed_call('customs', timings, _ep_get_customs_info)
+        ep_shipment = _timed_call(
+            'shipment', timings, _ep_create_shipment,
+            from_address_dict, to_address_dict, ep_parcel_object, customs_info_object)
 
     # Prevent error: "Unable to retrieve DHLExpress rates for US domestic ep_shipments."
-    if ep_to_address_object.country == 'US' and ep_from_address_object.country == 'US':
+    if _is_domestic(from_address_dict, to_address_dict):
         excluded.append('dhl')
     else:
         pass
 
-    # Get our rate
-    # Quote from easypost, just the expected DHL best quote
-    best_quote = {}
-    # Hard Code expensive rate and search for cheaper; allows for UPS
-    best_quote['rate'] = 99999999
-    for rate in ep_shipment.rates:
-        carrier = rate.carrier.casefold()
-        service = rate.service.casefold()
-        if carrier in str(excluded_dict.keys()) and service in excluded_dict[carrier]:
-            continue
-        # if rate.carrier.casefold() == 'usps' and rate.service.casefold() in EXCLUDED_USPS:
-        #     continue
-        # elif rate.service in str(excluded) or rate.carrier in str(excluded):
-        #     continue
-        elif carrier == 'usps' and (rate.rate != rate.list_rate):
-            # 2019-05-31 Ran into USPS quoting bug where priority mail was quoted way too 
-            # low by multiple providers. The "list_rate" was correct, though, and equal
-            # to what "rate" should have been. So testing for that here and healing, 
-            # but giving a warning in the service string so you know it happened
-            print("USPS quote appears to be wrong. Rate is %s, but list rate is %s. They should be equal."%(str(rate.rate),str(rate.list_rate)))
-            max_rate = max(float(rate.rate),float(rate.list_rate))
-            rate.rate = '%.2f'%(max_rate)
-            rate.service += ' *** LIST RATE (CPP, corrected) ***'
-        elif float(rate.rate) < best_quote['rate']:
-            best_quote['rate'] = float(rate.rate)
-            best_quote['service'] = rate.service
-            best_quote['carrier'] = rate.carrier
-            best_quote['source'] = 'easypost/' + rate.carrier_account_id.lower()
-            best_quote['quote_id'] = rate.id
-            best_quote['est_delivery_days'] = rate.est_delivery_days
-        else:
-            pass
-    
     # Quote from SS
     # Use corrected address from EasyPost
+    rates = rates_from_easypost(ep_shipment.rates)
     if 'fedex' in excluded:
         pass
+    elif ss_quotes_future is None and not _ss_can_win(
+            rate_table, rates, from_address_dict, to_address_dict, parcel_dict_oz):
+        pass
     else:
-        customer_name = 'Product Jump'
-        to_address_dict = ep_convert_address_object_to_dict(ep_to_address_object)
-        to_address_ss_object = ss_generate_address_object_from_dict(to_address_dict)
-        try:
-            predefined_package = parcel_dict_oz['predefined_package']
-            dimensions = {
-                'length': flat_rates[predefined_package]['length'],
-                'width': flat_rates[predefined_package]['width'],
-                'height': flat_rates[predefined_package]['height'],
-                'units': flat_rates[predefined_package]['units']
-            }
-        except KeyError:
-            ep_parcel_object = ep_generate_parcel_object(parcel_dict_oz)
-            dimensions = {
-                'length': parcel_dict_oz['length'],
-                'width': parcel_dict_oz['width'],
-                'height': parcel_dict_oz['height'],
-                'units': 'inches'
-            }
-        weight_grams = convert_ounces_to_grams(parcel_dict_oz['weight_oz'])
-        carrierCode = 'fedex'
-        # USPS: SIGNATURE: does pass to Shipment, does not add cost
-        # USPS: signature, ADULT_SIGNATURE does not register
-        # USPS: INDIRECT_SIGNATURE is error
-        delivery_confirmation='SIGNATURE'   
-        print("Hard coded: delivery_confirmation='SIGNATURE'")  
-        from_address_dict = ep_convert_address_object_to_dict(ep_from_address_object)
-        from_address_ss_object = ss_generate_address_object_from_dict(from_address_dict)
-        serviceCode = None
-        ss_quotes = get_quotes_for_carrier(
-            customer_name, to_address_ss_object, weight_grams, carrierCode,
-            dimensions, delivery_confirmation, from_address_ss_object, serviceCode)
-        
-        ss_quotes_to_return = {'ss_rates': []}
-        # Compare to previous and choose best one:
-        # NOTE: assumes there is an existing best quote
-        for q in ss_quotes:
-            carrier = q['carrierCode'].casefold()
-            service = q['serviceCode'].casefold()
-            q['total_cost'] = q['shipmentCost'] + q['otherCost']
-            ss_quotes_to_return['ss_rates'].append(
-                {
-                    'carrier': q['carrierCode'],
-                    'service': q['serviceName'],
-                    'rate': round(q['total_cost'],2),
-                    'est_delivery_days': None
-                }
-            )
-            if carrier in str(excluded_dict.keys()) and service in excluded_dict[carrier]:
-                continue
-            else:
-                q['total_cost'] = q['shipmentCost'] + q['otherCost']
-                if q['total_cost'] >= best_quote['rate']:
-                    continue
+        if concurrent:
+            if ss_quotes_future is None:
+                ss_deadline = min(time.monotonic() + provider_timeouts['shipstation'], quote_deadline or float('inf'))
+                ss_quotes_future = _submit_provider_call(
+                    'shipstation', ss_deadline, 'shipstation_quote', ss_timings,
+                    _ss_get_quotes, from_address_dict, to_address_dict, parcel_dict_oz, customer_name)
+            try:
+                ss_quotes = ss_quotes_future.result(timeout=_remaining(ss_deadline))
+                timings.update(ss_timings)
+            except (FutureTimeoutError, DeadlineExceeded):
+                print('shipstation did not answer in time, quoting without it')
+                ss_quotes = []
+                timed_out.append('shipstation')
+                METRICS.count('provider_timeouts', provider='shipstation')
+                late_quote_cache = quote_cache if cache_late_results else None
+                if late_quote_cache is not None or quote_history is not None:
+                    # Rates so far go in the history now, under the id the late ones will use
+                    history_quote = _record_rates(
+                        quote_history, from_address_dict, to_address_dict, parcel_dict_oz, rates)
+                    ss_quotes_future.add_done_callback(functools.partial(
+                        _cache_late_ss_quotes, list(rates), from_address_dict, to_address_dict,
+                        parcel_dict_oz, ep_shipment, customer_name, rate_table, late_quote_cache, cache_key,
+                        quote_history, history_quote))
                 else:
-                    best_quote['rate'] = q['total_cost']
-                    best_quote['service'] = q['serviceName']
-                    best_quote['carrier'] = q['carrierCode']
-                    best_quote['source'] = 'shipstation/' + customer_name.lower()
-                    best_quote['quote_id'] = None
+                    # Nobody wants the answer; drop it if it has not started
+                    ss_quotes_future.cancel()
+        else:
+            ss_quotes = _timed_call(
+                'shipstation_quote', timings,
+                _ss_get_quotes, from_address_dict, to_address_dict, parcel_dict_oz, customer_name)
+        rates.extend(rates_from_shipstation(ss_quotes, customer_name))
+    _observe_rates(rate_table, from_address_dict, to_address_dict, parcel_dict_oz, rates)
+    if history_quote is None:
+        _record_rates(quote_history, from_address_dict, to_address_dict, parcel_dict_oz, rates)
+    r, entry = _finish_quote(
+        rates, from_address_dict, to_address_dict, parcel_dict_oz, ep_shipment, timed_out, timings)
+    # A quote missing a provider is not what the next order on the lane should get
+    if entry is not None and quote_cache is not None and not timed_out:
+        quote_cache.put(cache_key, entry)
+    if r[0]:
+        METRICS.observe('quote_total', time.perf_counter() - quote_start, timings)
+        r[0]['stage_timings'] = timings   # seconds; concurrent stages overlap
+    return r, entry
+
+
+def _observe_rates(rate_table, from_address_dict, to_address_dict, parcel_dict_oz, rates):
+    if rate_table is not None:
+        # Excluded services can never win, keep them out of the floors
+        rate_table.observe(from_address_dict, to_address_dict, parcel_dict_oz, [
+            r for r in rates if (r.carrier.casefold(), r.service_code.casefold()) not in EXCLUDED_SERVICES])
 
-    # Get comparison rate; hard-coded to USPS Priority and EasyPost
+
+def _record_rates(quote_history, from_address_dict, to_address_dict, parcel_dict_oz, rates, quote=None):
+    """Returns:
+        quote(int): quote_history id of the quote, None without a quote_history"""
+    if quote_history is not None:
+        return quote_history.record(from_address_dict, to_address_dict, parcel_dict_oz, rates, quote=quote)
+
+
+def _cache_late_ss_quotes(ep_rates, from_address_dict, to_address_dict, parcel_dict_oz, ep_shipment,
+                          customer_name, rate_table, quote_cache, cache_key, quote_history, history_quote,
+                          ss_quotes_future):
+    """Done callback of a ShipStation quote that came in after its quote was returned:
+    the rates join their quote in quote_history, and the full quote goes in the cache
+    (if given) for the next order on the lane."""
+    try:
+        ss_quotes = ss_quotes_future.result()
+    except Exception:
+        return
+    METRICS.count('late_results', provider='shipstation')
+    ss_rates = rates_from_shipstation(ss_quotes, customer_name)
+    _record_rates(quote_history, from_address_dict, to_address_dict, parcel_dict_oz, ss_rates, history_quote)
+    if quote_cache is None:
+        return
+    _observe_rates(rate_table, from_address_dict, to_address_dict, parcel_dict_oz, ss_rates)
+    r, entry = _finish_quote(
+        ep_rates + ss_rates, from_address_dict, to_address_dict, parcel_dict_oz, ep_shipment, [], {})
+    if entry is not None:
+        quote_cache.put(cache_key, entry)
+
+
+def _finish_quote(rates, from_address_dict, to_address_dict, parcel_dict_oz, ep_shipment, timed_out, timings):
+    """Rates from all providers -> return value of pull_and_calculate_customer_facing_quote,
+    and its quote cache entry (None if it must not be reused)"""
+    ss_quotes_to_return = {'ss_rates': [
+        {
+            'carrier': r.carrier,
+            'service': r.service,
+            'rate': round(r.rate,2),
+            'est_delivery_days': None
+        }
+        for r in rates if r.provider == 'shipstation']}
+
+    # Get our rate, alternatives and the comparison rate in one pass
     # TODO: make INSURANCE_ESTIMATE dynamic
     try:
         INSURANCE_ESTIMATE = parcel_dict_oz['insurance_value']
@@ -296,36 +931,54 @@ def pull_and_calculate_customer_facing_quote(from_address_dict, to_address_dict,
     except KeyError:
         INSURANCE_ESTIMATE = 0
         print('Insurance value: ', INSURANCE_ESTIMATE)        
+    with METRICS.stage('rate_selection', timings):
+        selection = select_rates(rates)
+    if not selection['cheapest'] or selection['comparison'] is None:
+        print('Skipping: no usable rates', [str(r) for r in rates])
+        return SkippedQuote('no_rates'), None
+    best_quote = selection['cheapest'][0].to_dict()
+    best_quote['timed_out'] = timed_out
+    best_quote['alternatives'] = {
+        ranking: [r.to_dict() for r in selection[ranking]]
+        for ranking in ('cheapest', 'fastest', 'best_value')}
+    comparison_rate = selection['comparison']
     comparison_quote = {}
-    for rate in ep_shipment.rates:
-        if rate.carrier.casefold() == 'USPS'.casefold() and "Priority".casefold() in rate.service.casefold():
-            comparison_quote['rate'] = rate.rate
-            comparison_quote['rate'] = float(comparison_quote['rate']) + INSURANCE_ESTIMATE
-            comparison_quote['source'] = rate.carrier_account_id.lower()
-            comparison_quote['est_delivery_days'] = rate.est_delivery_days
-            if rate.carrier.casefold() in rate.service.casefold():
-                comparison_quote['service'] = rate.service
-            else:
-                comparison_quote['service'] = rate.carrier + ' ' + rate.service     
+    comparison_quote['rate'] = comparison_rate.rate + INSURANCE_ESTIMATE
+    comparison_quote['source'] = comparison_rate.source.split('/', 1)[1]
+    comparison_quote['est_delivery_days'] = comparison_rate.est_delivery_days
+    comparison_quote['carrier'] = comparison_rate.carrier
+    if comparison_rate.carrier.casefold() in comparison_rate.service.casefold():
+        comparison_quote['service'] = comparison_rate.service
+    else:
+        comparison_quote['service'] = comparison_rate.carrier + ' ' + comparison_rate.service     
     # pprint(comparison_quote)    # Debug
 
     # Then apply the additional fees, purchases
     # Only apply if our quote is better
-    if comparison_quote['service'].casefold() == best_quote['service'].casefold() and comparison_quote['carrier'].casefold() == best_quote['carrier'].casefold():
+    if selection['cheapest'][0] is comparison_rate:
         print('Skipping: best_quote = comparison_quote')
-        return({},{})
+        entry = {'skipped': True, 'skip_reason': 'best_is_comparison'}
+        return SkippedQuote('best_is_comparison'), entry
     # Skip quotes that are not cheaper
     elif comparison_quote['rate'] < best_quote['rate']:
-        print("Skipping: best_quote > comparison_quote", from_address_dict['city'], to_address_dict['city'], parcel_dict_oz['description'])
-        return({},{})
+        print("Skipping: best_quote > comparison_quote", from_address_dict['city'], to_address_dict['city'], parcel_dict_oz.get('description', ''))
+        entry = {'skipped': True, 'skip_reason': 'not_cheaper'}
+        return SkippedQuote('not_cheaper'), entry
     else:        
+        entry = {
+            'skipped': False,
+            'best_quote': dict(best_quote),   # before the headers below
+            'comparison_quote': dict(comparison_quote),
+            'ss_quotes': {'ss_rates': [dict(r) for r in ss_quotes_to_return['ss_rates']]},
+            }
         # Add header info at last stage of skipping here
         best_quote['from'] = from_address_dict # after verification
         best_quote['to'] = to_address_dict     # after verification
         best_quote['parcel'] = parcel_dict_oz   # includes item description
-    return (best_quote, comparison_quote, ep_shipment, ss_quotes_to_return)
+    return (best_quote, comparison_quote, ep_shipment, ss_quotes_to_return), entry
 
 
+@METRICS.timed('accounting')
 def calculate_accounting_info_from_customer_facing_quote(best_quote, comparison_quote):
     """Add platform fee and adjust for things like insurance.
     Print summary and useful info.
@@ -356,7 +1009,6 @@ def calculate_accounting_info_from_customer_facing_quote(best_quote, comparison_
                  $5,000.00 of coverage per package and $25,000.00 per conveyance.
         """
     
-    PLATFORM_FEE_PERCENT =?? #[REDACTED]
     value_insurance = 0 #    #TODO: pass this
     EP_INSURANCE_COST = value_insurance * .01   # easypost rate
     SS_INSURANCE_COST = 0   # unknown, may have shipsurance #TODO: modify call to add this
@@ -369,7 +1021,7 @@ def calculate_accounting_info_from_customer_facing_quote(best_quote, comparison_
     # Stop if coomparison is worse
     if comparison_quote['rate'] < our_quote['rate']:    #TODO: add threshholds
         print("Skipping: our_quote['rate'] > comparison_quote['rate']")
-        return({},{})
+        return SkippedQuote('not_cheaper_after_platform_fee')
 
     # Add header info at last stage of skipping here
     present_to_customer = {}
@@ -387,7 +1039,6 @@ def calculate_accounting_info_from_customer_facing_quote(best_quote, comparison_
     present_to_customer['savings_percent'] = round(100 * present_to_customer['savings'] / present_to_customer['comparison_quote'], 0)
     # pprint(present_to_customer)     # Debug
 
-    SHIPPING_ACCOUNT_HOLDER_RATE = ?? #[REDACTED]
     internal_accounting_info = {}
     # internal_accounting_info['customer name'] = ''
     internal_accounting_info['order timestamp'] = '2019-05-28'  #TODO: dynamic, or order ID
@@ -424,9 +1075,537 @@ def calculate_accounting_info_from_customer_facing_quote(best_quote, comparison_
     return (present_to_customer, internal_accounting_info)
 
 
-# TODO: Write function to create shipping label
-# def create_shipping_label(.....):
-#     .....
+def verified_label_addresses(from_address_dict, to_address_dict):
+    """Addresses as EasyPost corrected them, for buying a label; the 'from'/'to' of a quote
+    served from the cache / coalesced can be the addresses as given.
+
+    Returns:
+        tuple[0] from_address_dict(dict), tuple[1] to_address_dict(dict): with EasyPost 'id'
+    """
+    if 'id' not in from_address_dict:
+        from_address_dict = _ep_verify_address(from_address_dict)
+    if 'id' not in to_address_dict:
+        to_address_dict = _ep_verify_address(to_address_dict)
+    return from_address_dict, to_address_dict
+
+
+def ep_shipment_for_quote(quote, from_address_dict, to_address_dict, parcel_dict_oz):
+    """EasyPost shipment and rate id to buy a quote with: the quote's own shipment if it
+    has one, otherwise (quote served from the cache / coalesced) a new shipment for the same
+    service, at no more than the quoted rate.
+
+    Args:
+        quote(dict): 'quote' of an iter_accounting record
+        from/to_address_dict(dict): verified by EasyPost if they have an 'id', verified here otherwise
+
+    Returns:
+        tuple[0] ep_shipment(EP Object)
+        tuple[1] rate_id(str)
+
+    Raises:
+        ValueError: the service is not offered for the new shipment, or costs more than quoted
+    """
+    if quote.get('quote_id') and quote.get('shipment_id'):
+        ep_shipment = _provider_call('easypost', 'Shipment.retrieve', easypost.Shipment.retrieve, quote['shipment_id'])
+        return ep_shipment, quote['quote_id']
+    from_address_dict, to_address_dict = verified_label_addresses(from_address_dict, to_address_dict)
+    ep_parcel_object = _ep_create_parcel(parcel_dict_oz)
+    if _is_domestic(from_address_dict, to_address_dict):
+        customs_info_object = None
+    else:
+        customs_info_object = _ep_get_customs_info()
+    ep_shipment = _ep_create_shipment(from_address_dict, to_address_dict, ep_parcel_object, customs_info_object)
+    for rate in ep_shipment.rates:
+        if (rate.carrier.casefold() == quote['carrier'].casefold()
+                and rate.service.casefold() == quote['service_code'].casefold()):
+            # The customer was charged from the quote
+            if round(float(rate.rate), 2) > round(quote['rate'], 2):
+                raise ValueError('%s %s now %.2f, quoted %.2f' % (
+                    quote['carrier'], quote['service_code'], float(rate.rate), quote['rate']))
+            return ep_shipment, rate.id
+    raise ValueError('%s %s no longer offered for this shipment' % (quote['carrier'], quote['service_code']))
+
+
+def create_shipping_label(quote, from_address_dict, to_address_dict, parcel_dict_oz, label_format='PDF',
+                          ep_shipment=None, rate_id=None):
+    """Buy the label for an EasyPost quote. Spends money: the purchase is not sent again
+    after an error that may have reached the provider; label_purchase.py buys in bulk with
+    an idempotency ledger on top of this.
+    ShipStation quotes are not bought here (yet): their labels are bought in ShipStation.
+
+    Args:
+        quote(dict): 'quote' of an iter_accounting record (source, carrier, service_code, ...)
+        from/to_address_dict(dict): verified by EasyPost if they have an 'id', verified here otherwise
+        parcel_dict_oz(dict): dimensions in inches, weight with unit -oz
+        label_format(str): 'PDF', 'ZPL' or 'PNG'
+        ep_shipment, rate_id: from ep_shipment_for_quote if already made
+
+    Returns:
+        label(dict): provider, shipment_id, tracking_code, label_format, label_url
+
+    Raises:
+        ValueError: not an EasyPost quote
+    """
+    if not quote['source'].startswith('easypost/'):
+        raise ValueError('only EasyPost labels are bought here, not %r' % quote['source'])
+    if ep_shipment is None:
+        ep_shipment, rate_id = ep_shipment_for_quote(quote, from_address_dict, to_address_dict, parcel_dict_oz)
+    _provider_purchase('easypost', 'Shipment.buy', ep_shipment.buy, rate={'id': rate_id})
+    return {
+        'provider': 'easypost',
+        'shipment_id': ep_shipment.id,
+        'tracking_code': ep_shipment.tracking_code,
+        'label_format': label_format,
+        'label_url': ep_label_url(ep_shipment, label_format),
+    }
+
+
+def ep_label_url(ep_shipment, label_format='PDF'):
+    """Label url of a bought EasyPost shipment in label_format; converted
+    (one more API call) if EasyPost has not made that format yet"""
+    field = EP_LABEL_URL_FIELDS[label_format]
+    label_url = getattr(ep_shipment.postage_label, field, None)
+    if not label_url:
+        _provider_call('easypost', 'Shipment.label', ep_shipment.label, file_format=label_format)
+        label_url = getattr(ep_shipment.postage_label, field, None)
+    return label_url
+
+
+def iter_order_rows(CSV_PATH):
+    """Stream the order export one row at a time."""
+    with open(CSV_PATH) as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield row
+
+
+def iter_orders(rows, orders_to_pull=None):
+    """Order rows -> orders with all their line items, one pass.
+
+    Assumes
+        rows of one order are next to each other, as Shopify exports them; the first
+        row of an order has the shipping address, every row has one line item
+
+    Args:
+        orders_to_pull(set of str): casefolded order 'Name's to keep, default all
+
+    Yields:
+        order(dict): customer_order_id, to_address_dict, line_items (list of dict:
+            sku, name, quantity), and error (str) if a line item did not parse
+    """
+    order = None
+    seen = set()
+    for row in rows:
+        name = row['Name'].casefold()
+        if order is not None and name == order['customer_order_id'].casefold():
+            _add_line_item(order, row)
+            continue
+        if order is not None:
+            yield order
+            order = None
+        if orders_to_pull is not None and name not in orders_to_pull:
+            continue
+        if name in seen:
+            # Grouping is one pass; quoting the rest separately could buy two labels
+            print('Skipping rows of order %s: not next to its other rows' % row['Name'])
+            continue
+        seen.add(name)
+        to_address_dict = _order_row_to_address_dict(row)
+        order = {
+            'customer_order_id': to_address_dict['customer_order_id'],
+            'to_address_dict': to_address_dict,
+            'line_items': [],
+        }
+        _add_line_item(order, row)
+    if order is not None:
+        yield order
+
+
+def _add_line_item(order, row):
+    """Add the row's line item to the order; a row that does not parse sets the order's
+    'error' instead, the other orders go on"""
+    try:
+        order['line_items'].append(_order_row_to_line_item(row))
+    except ValueError as e:
+        order.setdefault('error', 'line item %r: %s' % (row.get('Lineitem sku', ''), e))
+
+
+def _order_row_to_line_item(row):
+    """Shopify export row -> line item; a blank quantity is one
+
+    Raises:
+        ValueError: quantity is not a whole number, or negative
+    """
+    quantity = int(row.get('Lineitem quantity') or 1)
+    if quantity < 0:
+        raise ValueError('negative quantity %d' % quantity)
+    return {
+        'sku': row.get('Lineitem sku', ''),
+        'name': row.get('Lineitem name', ''),
+        'quantity': quantity,
+    }
+
+
+def _item_profile(line_item, item_profiles):
+    """Packed size of a line item: largest side first, thinnest as height"""
+    profile = item_profiles.get(line_item['sku'])
+    if profile is None:
+        raise ValueError('no item profile for SKU %r' % line_item['sku'])
+    length, width, height = sorted((profile['length'], profile['width'], profile['height']), reverse=True)
+    return {'sku': line_item['sku'], 'name': line_item.get('name') or line_item['sku'],
+            'length': length, 'width': width, 'height': height, 'weight_oz': profile['weight_oz']}
+
+
+def _parcel_description(names):
+    """Parcel description from its items' names, each name once"""
+    return ', '.join(dict.fromkeys(names))
+
+
+def _consolidation_packages(boxes, flat_rate_contents_height):
+    """Flat rate envelopes (if flat_rate_contents_height) and boxes, smallest first.
+
+    Returns:
+        packages(list of dict): name, length, width, contents_height, tare_oz, predefined(bool)
+    """
+    packages = []
+    if flat_rate_contents_height is not None:
+        packages += [{
+            'name': name,
+            'length': max(package['length'], package['width']),
+            'width': min(package['length'], package['width']),
+            'contents_height': flat_rate_contents_height,
+            'tare_oz': 0,
+            'predefined': True,
+        } for name, package in FLAT_RATES.items()]
+    packages += [{
+        'name': name,
+        'length': max(box['length'], box['width']),
+        'width': min(box['length'], box['width']),
+        'contents_height': box['height'],
+        'tare_oz': box['tare_oz'],
+        'predefined': False,
+    } for name, box in boxes.items()]
+    return sorted(packages, key=lambda p: p['length'] * p['width'] * p['contents_height'])
+
+
+def _fits(package, length, width, height, weight_oz):
+    """Items lie flat and stack: footprint within the package, stack within its height"""
+    return (length <= package['length'] and width <= package['width']
+            and height <= package['contents_height'] and weight_oz + package['tare_oz'] <= MAX_PARCEL_WEIGHT_OZ)
+
+
+def consolidate_parcels(line_items, item_profiles, boxes=None, flat_rate_contents_height=None):
+    """Pack an order's line items into as few parcels as it can; first fit decreasing.
+
+    Items, largest first, go into the first parcel with room; a new parcel starts in
+    the largest package the item fits. Each parcel then moves to the smallest package
+    that holds its contents. An item no package holds ships on its own, in its own
+    dimensions.
+
+    Args:
+        line_items(list of dict): sku, quantity; see iter_orders
+        item_profiles(dict): 'Lineitem sku' -> packed item: length, width, height (inches),
+            weight_oz
+        boxes(dict): boxes we stock, name -> inside length, width, height (inches), tare_oz
+        flat_rate_contents_height(float): how thick contents the FLAT_RATES envelopes
+            still close over, inches; None to not pack into them
+
+    Returns:
+        parcels(list of dict): parcel_dict_oz for pull_and_calculate_customer_facing_quote,
+            predefined_package for flat rates; includes 'items' (list of SKUs) and a
+            'description' made of the item names. Empty if there are no items
+
+    Raises:
+        ValueError: an SKU is not in item_profiles
+    """
+    packages = _consolidation_packages(boxes or {}, flat_rate_contents_height)
+    items = [_item_profile(line_item, item_profiles) for line_item in line_items for _ in range(line_item['quantity'])]
+    items.sort(key=lambda i: (i['length'] * i['width'] * i['height'], i['weight_oz']), reverse=True)
+    bins = []   # contents of each parcel: footprint, stack height, weight, items
+    oversize = []
+    for item in items:
+        for b in bins:
+            if _fits(b['package'], max(b['length'], item['length']), max(b['width'], item['width']),
+                     b['height'] + item['height'], b['weight_oz'] + item['weight_oz']):
+                break
+        else:
+            package = next((p for p in reversed(packages) if _fits(
+                p, item['length'], item['width'], item['height'], item['weight_oz'])), None)
+            if package is None:
+                oversize.append(item)
+                continue
+            b = {'package': package, 'length': 0, 'width': 0, 'height': 0, 'weight_oz': 0, 'items': [], 'names': []}
+            bins.append(b)
+        b['length'] = max(b['length'], item['length'])
+        b['width'] = max(b['width'], item['width'])
+        b['height'] += item['height']
+        b['weight_oz'] += item['weight_oz']
+        b['items'].append(item['sku'])
+        b['names'].append(item['name'])
+
+    parcels = []
+    for b in bins:
+        package = next(p for p in packages if _fits(p, b['length'], b['width'], b['height'], b['weight_oz']))
+        if package['predefined']:
+            parcels.append({'predefined_package': package['name'], 'weight_oz': b['weight_oz'], 'items': b['items'],
+                            'description': _parcel_description(b['names'])})
+        else:
+            box = boxes[package['name']]
+            parcels.append({
+                'length': box['length'],
+                'width': box['width'],
+                'height': box['height'],
+                'weight_oz': b['weight_oz'] + box['tare_oz'],
+                'items': b['items'],
+                'description': _parcel_description(b['names']),
+            })
+    for item in oversize:
+        parcels.append({
+            'length': item['length'],
+            'width': item['width'],
+            'height': item['height'],
+            'weight_oz': item['weight_oz'],
+            'items': [item['sku']],
+            'description': item['name'],
+        })
+    return parcels
+
+
+def iter_quote_requests(rows, from_address_dict, parcel_dict_oz=None, orders_to_pull=None, packing=None):
+    """Order rows -> quote requests, one per parcel of each order.
+
+    Assumes
+        rows of one order are next to each other (see iter_orders)
+
+    Args:
+        parcel_dict_oz(dict): quote every order as this one parcel (see
+            pull_and_calculate_customer_facing_quote); None to pack each order's
+            line items with consolidate_parcels
+        orders_to_pull(set of str): casefolded order 'Name's to keep, default all
+        packing(dict): consolidate_parcels arguments: item_profiles, and boxes,
+            flat_rate_contents_height if any; needed without parcel_dict_oz
+
+    Yields:
+        request(dict): customer_order_id, from_address_dict, to_address_dict, parcel_dict_oz,
+            line_items, parcel_index, parcel_count. An order with no parcel to quote (its
+            rows did not parse, nothing to pack) is one request with parcel_count 0 and
+            'result': the error, or SkippedQuote('no_items')
+    """
+    if parcel_dict_oz is None and packing is None:
+        raise ValueError('packing (item_profiles, boxes) is needed to pack orders without parcel_dict_oz')
+    for order in iter_orders(rows, orders_to_pull):
+        request = {
+            'customer_order_id': order['customer_order_id'],
+            'from_address_dict': from_address_dict,
+            'to_address_dict': order['to_address_dict'],
+            'line_items': order['line_items'],
+        }
+        result = None
+        if order.get('error'):
+            parcels, result = [], ValueError(order['error'])
+        elif parcel_dict_oz is not None:
+            parcels = [parcel_dict_oz]
+        else:
+            try:
+                parcels = consolidate_parcels(order['line_items'], **packing)
+            except ValueError as e:
+                parcels, result = [], e
+        if not parcels:
+            yield dict(request, parcel_dict_oz=None, parcel_index=0, parcel_count=0,
+                       result=result if result is not None else SkippedQuote('no_items'))
+            continue
+        for parcel_index, parcel in enumerate(parcels):
+            yield dict(request, parcel_dict_oz=parcel, parcel_index=parcel_index, parcel_count=len(parcels))
+
+
+def _quote_request(request, quote_kwargs):
+    return pull_and_calculate_customer_facing_quote(
+        request['from_address_dict'], request['to_address_dict'], request['parcel_dict_oz'], **quote_kwargs)
+
+
+def iter_quotes(requests, max_workers=8, max_in_flight=None, **quote_kwargs):
+    """Quote requests on a thread pool, yielding each as soon as it is done.
+
+    Backpressure: at most max_in_flight requests are pulled from upstream and not yet
+    yielded, so memory does not grow with the size of the input.
+
+    Args:
+        max_workers(int): orders quoted at the same time
+        max_in_flight(int): default 2 * max_workers
+        quote_kwargs: passed to pull_and_calculate_customer_facing_quote
+
+    Yields:
+        (request(dict), result): result is what pull_and_calculate_customer_facing_quote
+            returned, or the exception it raised; a request's own 'result' (see
+            iter_quote_requests) is passed on without quoting
+    """
+    max_in_flight = max_in_flight or 2 * max_workers
+    requests = iter(requests)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='order') as pool:
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                    break
+                if 'result' in request:
+                    yield request, request['result']
+                    continue
+                in_flight[pool.submit(_quote_request, request, quote_kwargs)] = request
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                request = in_flight.pop(future)
+                try:
+                    yield request, future.result()
+                except Exception as e:
+                    yield request, e
+
+
+def iter_accounting(quotes):
+    """(request, quote result) -> one result record per order; never raises for an order.
+
+    Yields:
+        record(dict): customer_order_id, sales_platform__order_id, parcel_index and
+            parcel_count (an order packed into several parcels has a record for each; 0 for
+            an order with nothing to quote),
+            status ('quoted', 'skipped' or 'error'), skip_reason, present_to_customer,
+            internal_accounting_info, quote (what is needed to buy the label), stage_timings, error
+    """
+    for request, r in quotes:
+        record = {
+            'customer_order_id': request['customer_order_id'],
+            'sales_platform__order_id': request['to_address_dict'].get('sales_platform__order_id'),
+            'parcel_index': request.get('parcel_index', 0),
+            'parcel_count': request.get('parcel_count', 1),
+            'status': 'skipped',
+            'skip_reason': None,
+            'present_to_customer': {},
+            'internal_accounting_info': {},
+            'quote': None,
+            'stage_timings': None,
+            'error': None,
+        }
+        try:
+            if isinstance(r, Exception):
+                raise r
+            if isinstance(r, SkippedQuote):
+                record['skip_reason'] = r.reason
+            else:
+                best_quote, comparison_quote = r[0], r[1]
+                record['stage_timings'] = best_quote.get('stage_timings')
+                accounting = calculate_accounting_info_from_customer_facing_quote(best_quote, comparison_quote)
+                if isinstance(accounting, SkippedQuote):
+                    record['skip_reason'] = accounting.reason
+                else:
+                    record['status'] = 'quoted'
+                    record['present_to_customer'], record['internal_accounting_info'] = accounting
+                    record['quote'] = {
+                        'source': best_quote['source'],
+                        'carrier': best_quote['carrier'],
+                        'service': best_quote['service'],
+                        'service_code': best_quote['service_code'],
+                        'quote_id': best_quote['quote_id'],
+                        'shipment_id': r[2].id if r[2] is not None else None,
+                        'rate': best_quote['rate'],
+                        'timed_out': best_quote.get('timed_out', []),
+                    }
+        except Exception as e:
+            # One bad address should not stop the end-of-day run
+            record['status'] = 'error'
+            record['error'] = '%s: %s' % (type(e).__name__, e)
+        yield record
+
+
+def write_jsonl(records, output_file):
+    """Sink: write and flush each record as it arrives, passing it on.
+
+    Args:
+        output_file(file): open for writing, or None to only pass through
+    """
+    for record in records:
+        if output_file is not None:
+            output_file.write(json.dumps(record, default=str) + '\n')
+            output_file.flush()
+        yield record
+
+
+def stream_quotes(from_address_dict, parcel_dict_oz, CSV_PATH=CSV_PATH, output_path=None,
+                  orders_to_pull=None, max_workers=8, max_in_flight=None, packing=None, **quote_kwargs):
+    """order rows -> quote requests -> quotes -> accounting -> JSONL, one order at a time.
+
+    Each order's record is written as soon as it is ready, so downstream (labels)
+    can start while the run goes on; memory stays flat however big the CSV is.
+
+    Args:
+        parcel_dict_oz(dict): parcel used for every order; None to pack each order's
+            line items (consolidate_parcels)
+        output_path(str): JSONL file, one record per order parcel (see iter_accounting)
+        orders_to_pull(list of str): order 'Name's, default all
+        packing(dict): item_profiles, boxes, ...; see iter_quote_requests
+        quote_kwargs: passed to pull_and_calculate_customer_facing_quote
+            (concurrent, quote_cache, address_cache, rate_table, ...)
+
+    Yields:
+        record(dict)
+    """
+    if orders_to_pull is not None:
+        orders_to_pull = set(name.casefold() for name in orders_to_pull)
+    output_file = open(output_path, 'w') if output_path else None
+    try:
+        rows = iter_order_rows(CSV_PATH)
+        requests = iter_quote_requests(rows, from_address_dict, parcel_dict_oz, orders_to_pull, packing)
+        quotes = iter_quotes(requests, max_workers, max_in_flight, **quote_kwargs)
+        for record in write_jsonl(iter_accounting(quotes), output_file):
+            yield record
+    finally:
+        if output_file is not None:
+            output_file.close()
+        if quote_kwargs.get('quote_history') is not None:
+            quote_kwargs['quote_history'].flush()
+
+
+def quote_orders_batch(from_address_dict, parcel_dict_oz, CSV_PATH=CSV_PATH, orders_to_pull=None,
+                       max_workers=8, output_path=None, packing=None, **quote_kwargs):
+    """Quote many orders from the export, reading it once; stream_quotes collected into a list.
+
+    Args:
+        from_address_dict(dict): where the shipments are from
+        parcel_dict_oz(dict): parcel used for every order; None to pack each order's
+            line items (consolidate_parcels), one record per parcel
+        CSV_PATH(str): repo relative path to file to read
+        orders_to_pull(list of str): order 'Name's to quote, default all
+        max_workers(int): orders quoted at the same time
+        output_path(str): write one JSON line per order as it finishes
+        packing(dict): item_profiles, boxes, ...; see iter_quote_requests
+        quote_kwargs: passed to pull_and_calculate_customer_facing_quote
+            (concurrent, quote_cache, address_cache, rate_table, ...)
+
+    Returns:
+        records(list of dict): one per order, in completion order;
+            status is 'quoted', 'skipped', 'error' or 'not_found'
+    """
+    records = list(stream_quotes(
+        from_address_dict, parcel_dict_oz, CSV_PATH, output_path, orders_to_pull, max_workers,
+        packing=packing, **quote_kwargs))
+    if orders_to_pull is not None:
+        found = set(r['customer_order_id'].casefold() for r in records)
+        missing = [{'customer_order_id': name, 'status': 'not_found'}
+                   for name in orders_to_pull if name.casefold() not in found]
+        if missing and output_path:
+            with open(output_path, 'a') as output_file:
+                for record in missing:
+                    output_file.write(json.dumps(record) + '\n')
+        records.extend(missing)
+    print('Quoted %d orders: %d quoted, %d skipped, %d error, %d not found' % (
+        len(records),
+        sum(1 for r in records if r['status'] == 'quoted'),
+        sum(1 for r in records if r['status'] == 'skipped'),
+        sum(1 for r in records if r['status'] == 'error'),
+        sum(1 for r in records if r['status'] == 'not_found')))
+    return records
 
 
 def main(from_address_dict, to_address_dict, parcel_dict_oz):
@@ -447,8 +1626,9 @@ def main(from_address_dict, to_address_dict, parcel_dict_oz):
     print("******* internal accounting info *******")
     pprint(internal_accounting_info)
     print("******* Alternatives *******")
-    for rate in r[2].rates:
-        print('%s %s: $%s. Est delivery in %s days.'%(rate.carrier, rate.service, str(rate.rate), str(rate.est_delivery_days)))
+    for ranking, alternatives in r[0]['alternatives'].items():
+        for rate in alternatives:
+            print('%s: %s %s: $%.2f. Est delivery in %s days.'%(ranking, rate['carrier'], rate['service'], rate['rate'], str(rate['est_delivery_days'])))
     for rate in r[3]['ss_rates']:
         # Carrier name is included in the service field by shipstation
         print('%s: $%s. Est delivery in %s days.'%(rate['service'], str(rate['rate']), str(rate['est_delivery_days'])))
@@ -0,0 +1,143 @@
+# Copyright 2019 Eric Norman
+# Local rate table built from past quotes, used by quoting_engine.py to skip
+# provider calls that history says cannot win a lane.
+# Arrays are indexed [service, origin zone, destination zone, weight bucket].
+
+
+import json, threading
+import numpy as np
+
+
+# US zone is the first digit of the ZIP (0-9); everything outside the US is one zone
+N_ZONES = 11
+INTERNATIONAL_ZONE = 10
+# Upper edges of the billable weight buckets, ounces; heavier goes in the last bucket
+WEIGHT_BUCKETS_OZ = np.array([4, 8, 12, 16, 24, 32, 48, 64, 96, 128, 160, 240, 320, 480, 800])
+N_BUCKETS = len(WEIGHT_BUCKETS_OZ) + 1
+# Domestic dim weight divisor, cubic inches per pound
+DIM_DIVISOR = 139
+# Share of the way a floor moves up toward each price seen above it, so a price
+# increase ages the old low out instead of keeping it forever
+FLOOR_RISE = 0.2
+
+
+def zone_of(address_dict):
+    """Returns:
+        zone(int): 0-9 first ZIP digit for the US, INTERNATIONAL_ZONE otherwise"""
+    country = address_dict['country'].strip().casefold()
+    postal_code = address_dict['postal_code'].strip()
+    if country in ('us', 'usa', 'united states') and postal_code[:1].isdigit():
+        return int(postal_code[0])
+    return INTERNATIONAL_ZONE
+
+
+def weight_bucket_of(parcel_dict_oz):
+    """Billable weight bucket: the larger of actual and dim weight.
+
+    Returns:
+        bucket(int)
+    """
+    billable_oz = parcel_dict_oz['weight_oz']
+    if 'predefined_package' not in parcel_dict_oz:
+        dim_oz = 16 * parcel_dict_oz['length'] * parcel_dict_oz['width'] * parcel_dict_oz['height'] / DIM_DIVISOR
+        billable_oz = max(billable_oz, dim_oz)
+    return int(np.searchsorted(WEIGHT_BUCKETS_OZ, billable_oz, side='left'))
+
+
+class RateTable:
+    """Per carrier/service price history by lane and weight bucket.
+
+    Services are keyed (provider, carrier, service_code), lower case.
+    Keeps a floor (drops to any lower price at once, rises FLOOR_RISE of the way
+    toward each higher one) and the running mean.
+    """
+
+    def __init__(self):
+        self.services = {}  # (provider, carrier, service_code) -> row in the arrays
+        self.floor = np.full((0, N_ZONES, N_ZONES, N_BUCKETS), np.inf)
+        self.total = np.zeros((0, N_ZONES, N_ZONES, N_BUCKETS))
+        self.count = np.zeros((0, N_ZONES, N_ZONES, N_BUCKETS), dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def _lane(self, from_address_dict, to_address_dict, parcel_dict_oz):
+        return zone_of(from_address_dict), zone_of(to_address_dict), weight_bucket_of(parcel_dict_oz)
+
+    def _service_index(self, service):
+        # Caller holds the lock; grows the arrays by one service
+        index = self.services.get(service)
+        if index is None:
+            index = len(self.services)
+            self.services[service] = index
+            shape = (1, N_ZONES, N_ZONES, N_BUCKETS)
+            self.floor = np.concatenate([self.floor, np.full(shape, np.inf)])
+            self.total = np.concatenate([self.total, np.zeros(shape)])
+            self.count = np.concatenate([self.count, np.zeros(shape, dtype=np.int64)])
+        return index
+
+    def observe(self, from_address_dict, to_address_dict, parcel_dict_oz, rates):
+        """Add one quote's rates.
+
+        Args:
+            rates(list of Rate): see quoting_engine.Rate
+        """
+        o, d, w = self._lane(from_address_dict, to_address_dict, parcel_dict_oz)
+        with self._lock:
+            for rate in rates:
+                i = self._service_index(
+                    (rate.provider, rate.carrier.casefold(), rate.service_code.casefold()))
+                floor = self.floor[i, o, d, w]
+                if rate.rate <= floor:
+                    self.floor[i, o, d, w] = rate.rate
+                else:
+                    self.floor[i, o, d, w] = floor + FLOOR_RISE * (rate.rate - floor)
+                self.total[i, o, d, w] += rate.rate
+                self.count[i, o, d, w] += 1
+
+    def estimate(self, from_address_dict, to_address_dict, parcel_dict_oz):
+        """Mean historical price of every service seen on this lane.
+
+        Returns:
+            estimates(dict): (provider, carrier, service_code) -> price
+        """
+        o, d, w = self._lane(from_address_dict, to_address_dict, parcel_dict_oz)
+        with self._lock:
+            count = self.count[:, o, d, w]
+            mean = self.total[:, o, d, w] / np.maximum(count, 1)
+            return {service: float(mean[i]) for service, i in self.services.items() if count[i]}
+
+    def lane_floor(self, from_address_dict, to_address_dict, parcel_dict_oz, provider, carrier=None,
+                   min_observations=1):
+        """Lowest recent price a provider (optionally one carrier) has quoted this lane (see FLOOR_RISE).
+
+        Args:
+            min_observations(int): quotes of this lane needed before claiming a floor
+
+        Returns:
+            floor(float): inf if there is not enough history
+        """
+        o, d, w = self._lane(from_address_dict, to_address_dict, parcel_dict_oz)
+        with self._lock:
+            rows = [i for (p, c, s), i in self.services.items()
+                    if p == provider and (carrier is None or c == carrier.casefold())]
+            if not rows:
+                return float('inf')
+            count = self.count[rows, o, d, w]
+            if count.max() < min_observations:
+                return float('inf')
+            return float(self.floor[rows, o, d, w][count > 0].min())
+
+    def save(self, path):
+        """np.savez file; services go in as a json string"""
+        with self._lock:
+            np.savez(path, floor=self.floor, total=self.total, count=self.count,
+                     services=np.array(json.dumps(sorted(self.services.items(), key=lambda x: x[1]))))
+
+    @classmethod
+    def load(cls, path):
+        table = cls()
+        with np.load(path) as data:
+            table.floor = data['floor']
+            table.total = data['total']
+            table.count = data['count']
+            table.services = {tuple(service): i for service, i in json.loads(str(data['services']))}
+        return table
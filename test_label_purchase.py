@@ -0,0 +1,92 @@
+# Copyright 2019 Eric Norman
+# Label purchase against the fake providers: one order is never bought twice,
+# also when two buyers go for it at the same time.
+#
+#     python -m unittest test_label_purchase
+
+
+import os, tempfile, threading, unittest
+
+import fake_providers
+FAKES_OPTIONS = {'latency': {'easypost': 0.05, 'shipstation': 0.0}}
+fakes = fake_providers.install(**FAKES_OPTIONS)
+
+import bench_quoting
+import label_purchase
+
+
+def _record(quote):
+    return {
+        'customer_order_id': '#1001',
+        'sales_platform__order_id': '1',
+        'status': 'quoted',
+        'quote': dict({'quote_id': None, 'shipment_id': None, 'timed_out': []}, **quote),
+        'present_to_customer': {
+            'from': bench_quoting.FROM_ADDRESS_DICT,
+            'to': bench_quoting.to_address_dict(0),
+            'parcel': bench_quoting.PARCEL_DICT_OZ,
+        },
+    }
+
+
+SS_RECORD = _record({'source': 'shipstation/Product Jump', 'carrier': 'fedex', 'service': 'FedEx Ground',
+                     'service_code': 'fedex_ground', 'rate': 9.0})
+EP_RECORD = _record({'source': 'easypost/ca_fakeusps', 'carrier': 'USPS', 'service': 'Priority',
+                     'service_code': 'Priority', 'rate': 1000.0})
+
+
+def setUpModule():
+    # Another test module may have installed its own fakes since
+    global fakes
+    fakes = fake_providers.install(**FAKES_OPTIONS)
+
+
+class ConcurrentBuyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.ledger = label_purchase.LabelLedger(os.path.join(self.dir.name, 'ledger.sqlite3'))
+        self.buyer = label_purchase.LabelBuyer(self.ledger, os.path.join(self.dir.name, 'labels'),
+                                               download=fakes.download_label)
+        fakes.reset_counters()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _buy_twice_at_once(self, record):
+        barrier = threading.Barrier(2)
+        results = []
+
+        def buy():
+            barrier.wait()
+            results.append(self.buyer.buy(record))
+        threads = [threading.Thread(target=buy) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [result['status'] for result in results]
+
+    def _assert_one_bought(self, statuses):
+        statuses = list(statuses)
+        statuses.remove('bought')
+        self.assertIn(statuses[0], ('already_bought', 'in_progress'))
+
+    def test_easypost_bought_once(self):
+        statuses = self._buy_twice_at_once(EP_RECORD)
+        self.assertEqual(fakes.calls.get('Shipment.create'), 1)
+        self._assert_one_bought(statuses)
+
+    def test_rerun_does_not_buy_again(self):
+        self.assertEqual(self.buyer.buy(EP_RECORD)['status'], 'bought')
+        self.assertEqual(self.buyer.buy(EP_RECORD)['status'], 'already_bought')
+        self.assertEqual(fakes.calls.get('Shipment.create'), 1)
+
+    def test_shipstation_not_bought(self):
+        self.assertEqual(self.buyer.buy(SS_RECORD)['status'], 'not_bought')
+        self.assertIsNone(fakes.calls.get('ss_get_fedex_shipping_label'))
+        self.assertIsNone(self.ledger.get(label_purchase.idempotency_key(SS_RECORD)))
+
+
+if __name__ == '__main__':
+    unittest.main()
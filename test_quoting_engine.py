@@ -0,0 +1,185 @@
+# Copyright 2019 Eric Norman
+# Rate selection and the skip decisions of a quote, and orders from the export packed
+# into parcels, against the fake providers.
+#
+#     python -m unittest test_quoting_engine
+
+
+import unittest
+
+import fake_providers
+fake_providers.install()
+
+import bench_quoting
+import quoting_engine
+from quoting_engine import Rate, SkippedQuote
+
+
+def _ep(service, rate, list_rate=None, days=2, carrier='USPS'):
+    return Rate('easypost', carrier, service, service, rate, list_rate, days, 'easypost/ca_fakeusps', 'rate_' + service)
+
+
+def _ss(service, service_code, rate):
+    return Rate('shipstation', 'fedex', service, service_code, rate, source='shipstation/Product Jump')
+
+
+class SelectRatesTest(unittest.TestCase):
+
+    def test_cheapest_and_comparison(self):
+        priority = _ep('Priority', 8.0)
+        ground = _ss('FedEx Ground', 'fedex_ground', 7.0)
+        selection = quoting_engine.select_rates([priority, _ep('Express', 30.0, days=1), ground])
+        self.assertIs(selection['cheapest'][0], ground)
+        self.assertIs(selection['comparison'], priority)
+        self.assertEqual([r.service for r in selection['fastest']], ['Express', 'Priority'])
+
+    def test_excluded_services_left_out(self):
+        selection = quoting_engine.select_rates([_ep('ParcelSelect', 3.0), _ep('Priority', 8.0)])
+        self.assertEqual([r.service for r in selection['cheapest']], ['Priority'])
+
+    def test_international_priority_is_comparison(self):
+        international = _ep('PriorityMailInternational', 40.0)
+        self.assertIs(quoting_engine.select_rates([international])['comparison'], international)
+
+    def test_miss_quoted_usps_healed(self):
+        selection = quoting_engine.select_rates([_ep('Priority', 5.0, list_rate=9.0), _ep('Express', 30.0)])
+        self.assertEqual(selection['comparison'].rate, 9.0)
+        self.assertTrue(selection['comparison'].corrected)
+        self.assertEqual([r.service for r in selection['cheapest']], ['Express'])
+
+
+class FinishQuoteTest(unittest.TestCase):
+
+    def _finish(self, rates):
+        return quoting_engine._finish_quote(
+            rates, bench_quoting.FROM_ADDRESS_DICT, bench_quoting.to_address_dict(0),
+            dict(bench_quoting.PARCEL_DICT_OZ), None, [], {})
+
+    def test_best_is_comparison(self):
+        quote, entry = self._finish([_ep('Priority', 7.0), _ss('FedEx Ground', 'fedex_ground', 9.0)])
+        self.assertIsInstance(quote, SkippedQuote)
+        self.assertEqual(quote.reason, 'best_is_comparison')
+        self.assertEqual(entry, {'skipped': True, 'skip_reason': 'best_is_comparison'})
+
+    def test_cheaper_than_comparison(self):
+        (best_quote, comparison_quote, _, _), entry = self._finish(
+            [_ep('Priority', 9.0), _ss('FedEx Ground', 'fedex_ground', 7.0)])
+        self.assertEqual(best_quote['service_code'], 'fedex_ground')
+        self.assertEqual(comparison_quote['service'], 'USPS Priority')
+        self.assertFalse(entry['skipped'])
+
+    def test_no_comparison(self):
+        quote, entry = self._finish([_ss('FedEx Ground', 'fedex_ground', 7.0)])
+        self.assertEqual(quote.reason, 'no_rates')
+        self.assertIsNone(entry)
+
+
+
+def _row(name, sku, quantity='1', item_name=None):
+    return {
+        'Name': name, 'Id': name.strip('#'), 'Shipping Name': 'Customer', 'Shipping Street': '1 Main St',
+        'Shipping Address2': '', 'Shipping City': 'NYC', 'Shipping Province': 'NY', 'Shipping Zip': '10001',
+        'Shipping Country': 'US', 'Shipping Phone': '', 'Lineitem sku': sku,
+        'Lineitem name': item_name or sku, 'Lineitem quantity': quantity,
+    }
+
+
+PACKING = {
+    'item_profiles': {
+        'THIN': {'length': 6, 'width': 4, 'height': 0.3, 'weight_oz': 3},
+        'BOOK': {'length': 9, 'width': 6, 'height': 1.5, 'weight_oz': 20},
+        'BIG': {'length': 30, 'width': 20, 'height': 10, 'weight_oz': 200},
+    },
+    'boxes': {'Box': {'length': 12, 'width': 10, 'height': 4, 'units': 'inches', 'tare_oz': 5}},
+    'flat_rate_contents_height': 0.75,
+}
+
+
+class IterOrdersTest(unittest.TestCase):
+
+    def _orders(self, rows, orders_to_pull=None):
+        return list(quoting_engine.iter_orders(rows, orders_to_pull))
+
+    def test_rows_of_an_order_grouped(self):
+        orders = self._orders([_row('#1', 'THIN'), _row('#1', 'BOOK', '2'), _row('#2', 'THIN')])
+        self.assertEqual([o['customer_order_id'] for o in orders], ['#1', '#2'])
+        self.assertEqual([(i['sku'], i['quantity']) for i in orders[0]['line_items']], [('THIN', 1), ('BOOK', 2)])
+
+    def test_rows_not_next_to_their_order_left_out(self):
+        orders = self._orders([_row('#1', 'THIN'), _row('#2', 'THIN'), _row('#1', 'BOOK')])
+        self.assertEqual([o['customer_order_id'] for o in orders], ['#1', '#2'])
+        self.assertEqual([i['sku'] for i in orders[0]['line_items']], ['THIN'])
+
+    def test_orders_to_pull(self):
+        orders = self._orders([_row('#1', 'THIN'), _row('#2', 'THIN'), _row('#2', 'BOOK')], {'#2'})
+        self.assertEqual([(o['customer_order_id'], len(o['line_items'])) for o in orders], [('#2', 2)])
+
+    def test_quantities(self):
+        orders = self._orders([_row('#1', 'THIN', ''), _row('#2', 'THIN', '0')])
+        self.assertEqual([o['line_items'][0]['quantity'] for o in orders], [1, 0])
+
+    def test_bad_quantity_is_the_order_error(self):
+        orders = self._orders([_row('#1', 'THIN', 'x'), _row('#1', 'BOOK'), _row('#2', 'THIN', '-1'), _row('#3', 'THIN')])
+        self.assertEqual([o['customer_order_id'] for o in orders], ['#1', '#2', '#3'])
+        self.assertIn('invalid literal', orders[0]['error'])
+        self.assertIn('negative quantity', orders[1]['error'])
+        self.assertNotIn('error', orders[2])
+
+
+class ConsolidateParcelsTest(unittest.TestCase):
+
+    def _parcels(self, *line_items, **packing):
+        return quoting_engine.consolidate_parcels(
+            [{'sku': sku, 'name': sku, 'quantity': quantity} for sku, quantity in line_items],
+            **dict(PACKING, **packing))
+
+    def test_thin_items_in_a_flat_rate_envelope(self):
+        parcels = self._parcels(('THIN', 2))
+        self.assertEqual(parcels, [{'predefined_package': 'FlatRateEnvelope', 'weight_oz': 6,
+                                    'items': ['THIN', 'THIN'], 'description': 'THIN'}])
+
+    def test_thick_items_in_a_box(self):
+        parcels = self._parcels(('BOOK', 1), ('THIN', 1))
+        self.assertEqual(len(parcels), 1)
+        self.assertEqual((parcels[0]['length'], parcels[0]['width'], parcels[0]['height']), (12, 10, 4))
+        self.assertEqual(parcels[0]['weight_oz'], 20 + 3 + 5)
+        self.assertEqual(parcels[0]['description'], 'BOOK, THIN')
+
+    def test_no_flat_rates_without_contents_height(self):
+        parcels = self._parcels(('THIN', 1), flat_rate_contents_height=None)
+        self.assertNotIn('predefined_package', parcels[0])
+
+    def test_full_box_starts_another(self):
+        self.assertEqual([len(p['items']) for p in self._parcels(('BOOK', 3))], [2, 1])
+
+    def test_oversize_item_ships_alone(self):
+        parcels = self._parcels(('BIG', 1), ('THIN', 1))
+        self.assertEqual(len(parcels), 2)
+        self.assertEqual(parcels[1], {'length': 30, 'width': 20, 'height': 10, 'weight_oz': 200,
+                                      'items': ['BIG'], 'description': 'BIG'})
+
+    def test_no_items(self):
+        self.assertEqual(self._parcels(('THIN', 0)), [])
+
+    def test_unknown_sku(self):
+        with self.assertRaises(ValueError):
+            self._parcels(('NEW', 1))
+
+
+class OrdersWithoutParcelsTest(unittest.TestCase):
+
+    def test_error_and_no_items_records(self):
+        rows = [_row('#1', 'THIN', 'x'), _row('#2', 'THIN', '0'), _row('#3', 'NEW')]
+        requests = quoting_engine.iter_quote_requests(rows, bench_quoting.FROM_ADDRESS_DICT, packing=PACKING)
+        records = list(quoting_engine.iter_accounting(quoting_engine.iter_quotes(requests)))
+        self.assertEqual([(r['customer_order_id'], r['status'], r['skip_reason'], r['parcel_count']) for r in records],
+                         [('#1', 'error', None, 0), ('#2', 'skipped', 'no_items', 0), ('#3', 'error', None, 0)])
+        self.assertIn("no item profile for SKU 'NEW'", records[2]['error'])
+
+    def test_packing_needed_without_parcel(self):
+        with self.assertRaises(ValueError):
+            next(quoting_engine.iter_quote_requests([_row('#1', 'THIN')], bench_quoting.FROM_ADDRESS_DICT))
+
+
+if __name__ == '__main__':
+    unittest.main()